@@ -109,7 +109,7 @@ def get_stats():
     Fetches the Task matrix with `get_task_matrix`, then combines all the different ETA values into a single
     user-friendly ETA text with completed percentage and time to finish. Also computes total counts of the
     different objects (files, directories, de-duplicated documents, blobs) and their total sizes (in the
-    database and on disk).
+    database and on disk), and the number of unchanged directories pruned by the walks.
 
     Data is returned in a JSON-serializable python dict.
     """
@@ -117,6 +117,7 @@ def get_stats():
     blobs = models.Blob.objects
 
     [[db_size]] = raw_sql("select pg_database_size(current_database())")
+    walk_stats = models.Statistics.objects.filter(key='walk').values_list('value', flat=True).first() or {}
 
     def get_error_counts():
         col = collections.current()
@@ -159,6 +160,8 @@ def get_stats():
             'directories': models.Directory.objects.count(),
             'blob_count': blobs.count(),
             'blob_total_size': blobs.aggregate(Sum('size'))['size__sum'],
+            'pruned_directories': walk_stats.get('pruned_directories', 0),
+            'pruned_entries': walk_stats.get('pruned_entries', 0),
         },
         'db_size': db_size,
         'error_counts': list(get_error_counts()),
@@ -1,16 +1,26 @@
 """Tasks that unpack archives and return their structure and contents.
 """
 
+import logging
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from hashlib import sha1
 import re
+import shutil
+import tarfile
+import time
+import zipfile
+from django.conf import settings
+
 from ..tasks import snoop_task, SnoopTaskBroken, returns_json_blob
 from .. import models
 from .. import collections
 import os
 import tempfile
 
+log = logging.getLogger(__name__)
+
 SEVENZIP_MIME_TYPES = {
     'application/x-7z-compressed',
     'application/zip',
@@ -23,6 +33,43 @@ SEVENZIP_MIME_TYPES = {
     'application/x-tar',
 }
 
+ZIPFILE_MIME_TYPES = {
+    'application/zip',
+    'application/x-zip',
+}
+"""Archives we extract in-process with `zipfile`, falling back to `7z` if that fails."""
+
+TARFILE_MIME_TYPES = {
+    'application/x-tar',
+}
+"""Archives we extract in-process with `tarfile`, falling back to `7z` if that fails."""
+
+STREAMING_ERRORS = (
+    zipfile.BadZipFile,
+    zipfile.LargeZipFile,
+    tarfile.TarError,
+    NotImplementedError,
+    RuntimeError,
+    EOFError,
+    OSError,
+)
+"""Errors from `zipfile` and `tarfile` that make us retry the extraction with `7z`.
+
+Among others, these cover encrypted members and compression methods not supported by Python.
+"""
+
+MULTITHREADED_MIME_TYPES = {
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+}
+"""Formats that `7z` can decompress with more than one thread."""
+
+GZIP_MIME_TYPES = {
+    'application/x-gzip',
+    'application/gzip',
+}
+"""Formats decompressed with `pigz` instead of `7z`, when `pigz` is installed."""
+
 READPST_MIME_TYPES = {
     'application/x-hoover-pst',
 }
@@ -49,12 +96,114 @@ def is_archive(mime_type):
     return mime_type in ARCHIVES_MIME_TYPES
 
 
-def call_readpst(pst_path, output_dir):
+class ExtractionBudget:
+    """Tracks the resources used while unpacking one archive, and stops the extraction if it goes over
+    the limits.
+
+    The limits are read from the `extraction_limits` option of the current collection, which defaults to
+    [`EXTRACTION_LIMITS`][snoop.defaultsettings.EXTRACTION_LIMITS]. Going over one of them raises
+    [SnoopTaskBroken][snoop.data.tasks.SnoopTaskBroken] with one of these reasons: `archive_size_limit`,
+    `archive_member_limit`, `archive_ratio_limit`, `archive_time_limit`.
+    """
+
+    MIN_RATIO_BASE = 2 ** 20
+    """Archives smaller than this are counted as having this size when computing the compression ratio."""
+
+    def __init__(self, archive_size, limits=None):
+        self.limits = limits or collections.current().extraction_limits
+        self.archive_size = archive_size
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.members = 0
+
+    def check(self):
+        """Raises if any of the limits were exceeded."""
+
+        if self.bytes > self.limits['max_bytes']:
+            raise SnoopTaskBroken(f'extracted more than {self.limits["max_bytes"]} bytes',
+                                  'archive_size_limit')
+        if self.members > self.limits['max_members']:
+            raise SnoopTaskBroken(f'extracted more than {self.limits["max_members"]} files',
+                                  'archive_member_limit')
+        if self.bytes > self.limits['max_ratio'] * max(self.archive_size, self.MIN_RATIO_BASE):
+            raise SnoopTaskBroken(f'compression ratio over {self.limits["max_ratio"]}',
+                                  'archive_ratio_limit')
+        if time.monotonic() - self.started > self.limits['max_seconds']:
+            raise SnoopTaskBroken(f'extraction took more than {self.limits["max_seconds"]}s',
+                                  'archive_time_limit')
+
+    def add(self, members=0, size=0):
+        """Counts new extracted data, then checks the limits."""
+
+        self.members += members
+        self.bytes += size
+        self.check()
+
+    def set_totals(self, members, size):
+        """Updates the counters with totals measured on disk, then checks the limits."""
+
+        self.members = members
+        self.bytes = size
+        self.check()
+
+
+def directory_usage(path):
+    """Returns the number of files and their total size under the given path."""
+
+    count = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+    return count, size
+
+
+def run_limited(args, output_dir, budget, cwd=None, poll_interval=2, stdout=None):
+    """Runs an extraction process, killing it if its output goes over the budget.
+
+    The output directory is measured every `poll_interval` seconds while the process runs, and once more
+    after it exits. If `stdout` is an open file, the process writes its output there and only its
+    `stderr` is captured.
+
+    Raises:
+        subprocess.CalledProcessError: if the process fails
+        SnoopTaskBroken: if the budget was exceeded
+    """
+
+    if stdout is None:
+        streams = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
+    else:
+        streams = {'stdout': stdout, 'stderr': subprocess.PIPE}
+
+    with subprocess.Popen(args, cwd=cwd, **streams) as proc:
+        try:
+            while True:
+                try:
+                    output, errors = proc.communicate(timeout=poll_interval)
+                    output = output if stdout is None else errors
+                    break
+                except subprocess.TimeoutExpired:
+                    budget.set_totals(*directory_usage(output_dir))
+        except BaseException:
+            proc.kill()
+            raise
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, output)
+    budget.set_totals(*directory_usage(output_dir))
+    return output
+
+
+def call_readpst(pst_path, output_dir, budget):
     """Helper function that calls a `readpst` process."""
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     try:
-        subprocess.check_output([
+        run_limited([
             'readpst',
             '-D',
             '-M',
@@ -63,97 +212,393 @@ def call_readpst(pst_path, output_dir):
             str(output_dir),
             '-teajc',
             str(pst_path),
-        ], stderr=subprocess.STDOUT)
+        ], output_dir, budget)
 
     except subprocess.CalledProcessError:
         raise SnoopTaskBroken('readpst failed', 'readpst_error')
 
 
-def call_7z(archive_path, output_dir):
+def extraction_threads(blob):
+    """Picks the number of threads used to decompress an archive.
+
+    Formats that can't be decompressed in parallel get a single thread. The others get one thread for every
+    [`EXTRACTION_BYTES_PER_THREAD`][snoop.defaultsettings.EXTRACTION_BYTES_PER_THREAD] of archive, but no
+    more than the CPUs left idle by the current load on this node, and no more than
+    [`EXTRACTION_MAX_THREADS`][snoop.defaultsettings.EXTRACTION_MAX_THREADS].
+    """
+
+    if blob.mime_type not in MULTITHREADED_MIME_TYPES:
+        return 1
+
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0
+    idle = int((os.cpu_count() or 1) - load)
+    wanted = blob.size // settings.EXTRACTION_BYTES_PER_THREAD + 1
+    return max(1, min(wanted, idle, settings.EXTRACTION_MAX_THREADS))
+
+
+def call_7z(archive_path, output_dir, budget, threads=1):
     """Helper function that calls a `7z` process."""
 
     try:
-        subprocess.check_output([
+        run_limited([
             '7z',
             '-y',
             '-pp',
+            f'-mmt{threads}',
             'x',
             str(archive_path),
             '-o' + str(output_dir),
-        ], stderr=subprocess.STDOUT)
+        ], output_dir, budget)
 
     except subprocess.CalledProcessError:
         raise SnoopTaskBroken("7z extraction failed", '7z_error')
 
 
-def unpack_mbox(mbox_path, output_dir):
-    """Split a MBOX into emails."""
+def gzip_member_name(archive_path):
+    """Returns the original file name stored in the header of a gzip file, or `None`."""
 
-    def slice(stream):
-        last = b''
+    with open(archive_path, 'rb') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:2] != b'\x1f\x8b' or not header[3] & 0x08:
+            return None
+        if header[3] & 0x04:
+            f.seek(int.from_bytes(f.read(2), 'little'), os.SEEK_CUR)
+        name = bytearray()
         while True:
-            buffer = stream.read(1024 * 64)
-            if not buffer:
+            c = f.read(1)
+            if c in (b'', b'\0'):
                 break
-            window = last + buffer
-            while True:
-                m = re.search(br'\n\r?\n(From )', window)
-                if not m:
-                    break
-                offset = m.start(1)
-                yield window[:offset]
-                window = window[offset:]
-            last = window
-        yield last
+            name += c
+    return os.path.basename(name.decode('latin-1')) or None
+
+
+def call_pigz(archive_path, output_dir, budget):
+    """Decompresses a gzip file with `pigz`, which reads, writes and checksums in separate threads.
+
+    The output file is named like `7z` would name it: with the name stored in the gzip header, or after the
+    archive itself.
+    """
+
+    name = gzip_member_name(archive_path) or Path(archive_path).name
+    try:
+        with open(Path(output_dir) / name, 'wb') as output:
+            run_limited(['pigz', '-d', '-c', str(archive_path)], output_dir, budget, stdout=output)
+
+    except subprocess.CalledProcessError:
+        raise SnoopTaskBroken("pigz extraction failed", 'pigz_error')
+
+
+MBOX_SEPARATOR = re.compile(br'\n\r?\n(From )')
+"""Messages in a MBOX start with a "From " line, after an empty line."""
+
+
+def mbox_offsets(data):
+    """Finds the messages in a MBOX with a single pass over the data.
+
+    Args:
+        data: the MBOX contents, as bytes or a memoryview (see [snoop.data.models.Blob.mmap][])
+
+    Yields:
+        `(offset, length)` tuples, one per message.
+    """
+    start = 0
+    for m in MBOX_SEPARATOR.finditer(data):
+        yield start, m.start(1) - start
+        start = m.start(1)
+    yield start, len(data) - start
+
+
+def mbox_message_name(n):
+    """Returns the path of the n-th message (counting from 1) in the listing of a MBOX."""
+    hash = sha1(str(n).encode('utf-8')).hexdigest()
+    return '{}/{}.eml'.format(hash[:2], hash)
+
+
+def stream_mbox(blob, budget, chunk_size=2 ** 16):
+    """Splits a MBOX into emails, copying each one straight into a Blob.
+
+    Returns:
+        list: the archive listing
+    """
+    builder = ListingBuilder()
+    with blob.mmap() as data:
+        for n, (offset, length) in enumerate(mbox_offsets(data), 1):
+            budget.add(members=1, size=length)
+            with models.Blob.create() as writer:
+                for pos in range(offset, offset + length, chunk_size):
+                    writer.write(data[pos:min(pos + chunk_size, offset + length)])
+            builder.add_file(mbox_message_name(n), writer.blob.pk)
+    return builder.listing()
+
+
+def pdf_page_count(pdf_path):
+    """Returns the number of pages in a PDF, as reported by `pdfinfo`, or 0 if it can't tell."""
 
-    with open(mbox_path, 'rb') as f:
-        for n, message in enumerate(slice(f), 1):
-            hash = sha1(str(n).encode('utf-8')).hexdigest()
-            eml_path = Path(output_dir) / hash[:2] / '{}.eml'.format(hash)
-            eml_path.parent.mkdir(parents=True, exist_ok=True)
-            with eml_path.open('wb') as f:
-                f.write(message)
+    try:
+        output = subprocess.check_output(['pdfinfo', str(pdf_path)], stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        log.warning('pdfinfo failed on %s', pdf_path)
+        return 0
+    m = re.search(br'^Pages:\s+(\d+)', output, re.MULTILINE)
+    return int(m.group(1)) if m else 0
+
+
+def pdf_image_list(pdf_path):
+    """Lists the images in a PDF with `pdfimages -list`.
+
+    Returns:
+        list: `(page, num, width, height)` tuples, where `num` is the image number used in the file names
+        written by `pdfimages`.
+    """
+
+    output = subprocess.check_output(['pdfimages', '-list', str(pdf_path)], stderr=subprocess.DEVNULL)
+    images = []
+    for line in output.decode('latin1').splitlines()[2:]:
+        fields = line.split()
+        if len(fields) >= 5 and fields[0].isdigit():
+            images.append(tuple(int(x) for x in fields[:2]) + (int(fields[3]), int(fields[4])))
+    return images
+
+
+PDF_IMAGE_NAME = re.compile(r'^page-(\d+)-(\d+)\.(\w+)$')
+"""Matches the names of the files written by `pdfimages -p page`."""
+
+
+def convert_ccitt(ccitt):
+    """Converts a CCITT image written by `pdfimages` into a PNG with the same name."""
+
+    # As per pdfimages help text, use
+    # fax2tiff to re-create the tiff files from .ccitt, then get pngs from tiff.
+    # Using its own tiff convertor outputs images with reversed color.
+    params = ccitt.with_suffix('.params')
+    tif = ccitt.with_suffix('.tif')
+    png = ccitt.with_suffix('.png')
+
+    with params.open('r') as f:
+        params_text = f.read().strip()
+    subprocess.check_call(f'fax2tiff -o {str(tif)} {str(ccitt)} {params_text}',
+                          cwd=ccitt.parent, shell=True)
+    ccitt.unlink()
+    params.unlink()
+
+    subprocess.check_call(['convert', str(tif), str(png)], cwd=ccitt.parent)
+    tif.unlink()
+
+
+def unpack_pdf(pdf_path, output_dir, budget):
+    """Extract images from pdf by calling `pdfimages`.
 
+    The document is split in ranges of
+    [`PDF_IMAGES_PAGES_PER_RUN`][snoop.defaultsettings.PDF_IMAGES_PAGES_PER_RUN] pages, and `pdfimages` runs
+    on [`PDF_IMAGES_THREADS`][snoop.defaultsettings.PDF_IMAGES_THREADS] ranges at the same time, each
+    writing into its own directory. The image numbers in the file names are then
+    changed to the ones for the whole document, so we get the same names as from a single run. If `pdfinfo`
+    can't tell the number of pages, `pdfimages` runs once on the whole document instead.
 
-def unpack_pdf(pdf_path, output_dir):
-    """Extract images from pdf by calling `pdfimages`."""
+    Images smaller than [`PDF_IMAGES_MIN_SIZE`][snoop.defaultsettings.PDF_IMAGES_MIN_SIZE] pixels on either
+    side are dropped, and so are images identical to another one in the document (logos, letterheads), so
+    they don't end up as separate Files and OCR Tasks.
+    """
 
+    output_dir = Path(output_dir)
     try:
-        subprocess.check_call(
-            [
-                'pdfimages',
-                str(pdf_path),
-                # '-all',  # only output common image types
-                '-j', '-png', '-ccitt',
-                '-p',
-                'page',
-            ],
-            stderr=subprocess.STDOUT,
-            cwd=output_dir,
-        )
-
-        # As per pdfimages help text, use
-        # fax2tiff to re-create the tiff files from .ccitt, then get pngs from tiff.
-        # Using its own tiff convertor outputs images with reversed color.
-        fax = (Path(output_dir) / 'fax.tif')
-        for ccitt in Path(output_dir).glob('*.ccitt'):
-            params = ccitt.with_suffix('.params')
-            png = ccitt.with_suffix('.png')
-
-            with params.open('r') as f:
-                params_text = f.read().strip()
-            subprocess.check_call(f'fax2tiff {str(ccitt)} {params_text}',
-                                  cwd=output_dir, shell=True)
-            ccitt.unlink()
-            params.unlink()
-
-            subprocess.check_call(f'convert {str(fax)} {str(png)}',
-                                  shell=True, cwd=output_dir)
-            fax.unlink()
+        page_count = pdf_page_count(pdf_path)
+        images = pdf_image_list(pdf_path)
+        if not images:
+            return
+
+        step = settings.PDF_IMAGES_PAGES_PER_RUN
+        ranges = [(first, min(first + step - 1, page_count)) for first in range(1, page_count + 1, step)]
+        if not ranges:
+            ranges = [(1, None)]
+
+        def extract_range(page_range):
+            first, last = page_range
+            run_dir = output_dir / f'.pages-{first}'
+            run_dir.mkdir()
+            run_limited(
+                [
+                    'pdfimages',
+                    *(['-f', str(first), '-l', str(last)] if last else []),
+                    # '-all',  # only output common image types
+                    '-j', '-png', '-ccitt',
+                    '-p',
+                    str(pdf_path),
+                    'page',
+                ],
+                output_dir,
+                budget,
+                cwd=run_dir,
+            )
+            for ccitt in run_dir.glob('*.ccitt'):
+                convert_ccitt(ccitt)
+
+        with ThreadPoolExecutor(max_workers=settings.PDF_IMAGES_THREADS) as pool:
+            list(pool.map(extract_range, ranges))
 
     except subprocess.CalledProcessError:
         raise SnoopTaskBroken("pdfimages extraction failed", 'pdfimages_error')
 
+    # image numbers restart from 0 in every run; the first image on the first page gets the lowest number
+    min_size = settings.PDF_IMAGES_MIN_SIZE
+    first_num = {}
+    sizes = {}
+    for page, num, width, height in images:
+        first_num.setdefault(page, num)
+        sizes[num] = (width, height)
+
+    seen = set()
+    for first, last in ranges:
+        run_dir = output_dir / f'.pages-{first}'
+        pages = range(first, last + 1) if last else first_num
+        offset = min((first_num[p] for p in pages if p in first_num), default=0)
+        for path in sorted(run_dir.iterdir()):
+            m = PDF_IMAGE_NAME.match(path.name)
+            if not m:
+                path.unlink()
+                continue
+            num = offset + int(m.group(2))
+            width, height = sizes.get(num, (min_size, min_size))
+            digest = models.file_sha3_256(path)
+            if width < min_size or height < min_size or digest in seen:
+                path.unlink()
+                continue
+            seen.add(digest)
+            path.rename(output_dir / f'page-{m.group(1)}-{num:03d}.{m.group(3)}')
+        run_dir.rmdir()
+
+
+class ListingBuilder:
+    """Builds an archive listing (in the format of [snoop.data.analyzers.archives.archive_walk][], with the
+    `blob_pk` already set) from member paths, in any order.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def _get_dir(self, parts):
+        children = self.root
+        for part in parts:
+            entry = children.setdefault(part, {'type': 'directory', 'name': part, 'children': {}})
+            if entry['type'] != 'directory':
+                raise RuntimeError(f'archive member {part!r} is both a file and a directory')
+            children = entry['children']
+        return children
+
+    @staticmethod
+    def split(member_path):
+        """Splits a member path into names, dropping empty, `.` and `..` parts."""
+        return [part for part in member_path.split('/') if part not in ('', '.', '..')]
+
+    def add_directory(self, member_path):
+        self._get_dir(self.split(member_path))
+
+    def add_file(self, member_path, blob_pk):
+        parts = self.split(member_path)
+        if not parts:
+            return
+        children = self._get_dir(parts[:-1])
+        children[parts[-1]] = {'type': 'file', 'name': parts[-1], 'blob_pk': blob_pk}
+
+    def listing(self):
+        def convert(children):
+            for entry in children.values():
+                if entry['type'] == 'directory':
+                    yield dict(entry, children=list(convert(entry['children'])))
+                else:
+                    yield entry
+        return list(convert(self.root))
+
+
+def blob_from_stream(stream, budget):
+    """Copies a file-like object into a new Blob, returns its primary key."""
+
+    budget.add(members=1)
+    with models.Blob.create() as writer:
+        for block in models.chunks(stream):
+            budget.add(size=len(block))
+            writer.write(block)
+    return writer.blob.pk
+
+
+def stream_zip(archive_path, budget):
+    """Reads a zip archive with `zipfile`, copying each member straight into a Blob.
+
+    Returns:
+        list: the archive listing
+    """
+    builder = ListingBuilder()
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                builder.add_directory(info.filename)
+                continue
+            with archive.open(info) as member:
+                builder.add_file(info.filename, blob_from_stream(member, budget))
+    return builder.listing()
+
+
+def stream_tar(archive_path, budget):
+    """Reads a tar archive with `tarfile`, copying each member straight into a Blob.
+
+    Links and special files are skipped.
+
+    Returns:
+        list: the archive listing
+    """
+    builder = ListingBuilder()
+    with tarfile.open(archive_path, mode='r:') as archive:
+        for info in archive:
+            if info.isdir():
+                builder.add_directory(info.name)
+            elif info.isfile():
+                builder.add_file(info.name, blob_from_stream(archive.extractfile(info), budget))
+    return builder.listing()
+
+
+def stream_archive(blob, budget):
+    """Extracts the archive in-process, if it's a format we can stream.
+
+    MBOX files are always split in-process; for zip and tar archives, errors make us fall back to `7z`.
+
+    Returns:
+        list: the archive listing, or `None` if the archive must be extracted with `7z`.
+    """
+    if blob.mime_type in MBOX_MIME_TYPES:
+        return stream_mbox(blob, budget)
+
+    if blob.mime_type in ZIPFILE_MIME_TYPES:
+        extract = stream_zip
+    elif blob.mime_type in TARFILE_MIME_TYPES:
+        extract = stream_tar
+    else:
+        return None
+
+    try:
+        return extract(blob.path(), budget)
+    except STREAMING_ERRORS as e:
+        log.warning('streaming extraction failed for %s, falling back to 7z: %r', blob, e)
+        budget.set_totals(0, 0)
+        return None
+
+
+def check_nesting_depth(files):
+    """Raises if all the given Files are nested deeper than the `max_depth`
+    [extraction limit][snoop.defaultsettings.EXTRACTION_LIMITS].
+
+    Args:
+        files: the Files holding the same archive; if there are none, nothing is checked
+    """
+
+    # every container adds a "//" to the path, see `models.get_path_bytes()`
+    depths = [models.get_path_bytes(file).count(b'//') + 1 for file in files]
+    max_depth = collections.current().extraction_limits['max_depth']
+    if depths and min(depths) > max_depth:
+        raise SnoopTaskBroken(f'archive nested more than {max_depth} levels deep', 'archive_nesting_limit')
+
 
 def check_recursion(listing, blob_pk):
     """Raise exception if archive (blob_pk) is contained in itself (listing)."""
@@ -169,30 +614,68 @@ def check_recursion(listing, blob_pk):
 
 @snoop_task('archives.unarchive', priority=2)
 @returns_json_blob
-def unarchive(blob):
+def unarchive(blob, **depends_on):
     """Task to extract from an archive (or archive-looking) file its children.
 
     Runs on archives, email archives and any other file types that can contain another file (such as
     documents that embed images).
+
+    Zip and tar archives and MBOX files are read in-process by
+    [snoop.data.analyzers.archives.stream_archive][], with every member copied straight into a Blob;
+    everything else (and any archive Python can't read) is extracted to a temporary directory by an
+    external tool first. PST files are read by many smaller Tasks from [snoop.data.analyzers.pst][] when
+    `pypff` is available; their results are added as dependencies of this Task.
+
+    All the extraction methods are bound by an
+    [ExtractionBudget][snoop.data.analyzers.archives.ExtractionBudget]. Archives found only deeper than the
+    `max_depth` limit are not extracted at all, see [snoop.data.analyzers.archives.check_nesting_depth][].
     """
 
+    from . import pst
+
+    check_nesting_depth(models.File.objects.filter(original=blob))
+
+    t0 = time.time()
+    budget = ExtractionBudget(blob.size)
+    if blob.mime_type in READPST_MIME_TYPES and pst.can_read_natively():
+        listing = pst.unpack(blob, depends_on, budget)
+    else:
+        listing = stream_archive(blob, budget)
+    if listing is None:
+        listing = extract_to_temp_dir(blob, budget)
+
+    check_recursion(listing, blob.pk)
+
+    duration = max(time.time() - t0, 0.001)
+    log.info('unarchive %s (%s): read %s bytes at %.1f MB/s, extracted %s files with %s bytes at %.1f MB/s',
+             blob, blob.mime_type, blob.size, blob.size / duration / 2 ** 20,
+             budget.members, budget.bytes, budget.bytes / duration / 2 ** 20)
+
+    return listing
+
+
+def extract_to_temp_dir(blob, budget):
+    """Extracts the archive with an external tool into a temporary directory, then stores the files found.
+
+    Returns:
+        list: the archive listing
+    """
     base = collections.current().tmp_dir / str(blob)
     base.mkdir(parents=True, exist_ok=True)
     with tempfile.TemporaryDirectory(dir=base) as temp_dir:
-        if blob.mime_type in SEVENZIP_MIME_TYPES:
-            call_7z(blob.path(), temp_dir)
+        if blob.mime_type in GZIP_MIME_TYPES and shutil.which('pigz'):
+            call_pigz(blob.path(), temp_dir, budget)
+        elif blob.mime_type in SEVENZIP_MIME_TYPES:
+            threads = extraction_threads(blob)
+            log.debug('extracting %s with %s threads', blob, threads)
+            call_7z(blob.path(), temp_dir, budget, threads)
         elif blob.mime_type in READPST_MIME_TYPES:
-            call_readpst(blob.path(), temp_dir)
-        elif blob.mime_type in MBOX_MIME_TYPES:
-            unpack_mbox(blob.path(), temp_dir)
+            call_readpst(blob.path(), temp_dir, budget)
         elif blob.mime_type in PDF_MIME_TYPES:
-            unpack_pdf(blob.path(), temp_dir)
+            unpack_pdf(blob.path(), temp_dir, budget)
 
         listing = list(archive_walk(Path(temp_dir)))
         create_blobs(listing)
-
-    check_recursion(listing, blob.pk)
-
     return listing
 
 
@@ -214,13 +697,30 @@ def archive_walk(path):
             }
 
 
-def create_blobs(dirlisting):
-    """Create blobs for files in archive listing created by [snoop.data.analyzers.archive_walk."""
+def iter_file_entries(dirlisting):
+    """Yields all the file entries in an archive listing, recursively."""
 
     for entry in dirlisting:
         if entry['type'] == 'file':
-            path = Path(entry['path'])
-            entry['blob_pk'] = models.Blob.create_from_file(path).pk
-            del entry['path']
+            yield entry
         else:
-            create_blobs(entry['children'])
+            yield from iter_file_entries(entry['children'])
+
+
+def create_blobs(dirlisting):
+    """Create blobs for files in archive listing created by [snoop.data.analyzers.archive_walk.
+
+    All the files are hashed first, then checked for existence with a few batched queries; only the files
+    that are new are copied into Blobs.
+    """
+
+    entries = list(iter_file_entries(dirlisting))
+    for entry in entries:
+        entry['blob_pk'] = models.file_sha3_256(entry['path'])
+
+    existing = models.Blob.existing_pks(entry['blob_pk'] for entry in entries)
+    for entry in entries:
+        if entry['blob_pk'] not in existing:
+            entry['blob_pk'] = models.Blob.copy_from_file(Path(entry['path'])).pk
+            existing.add(entry['blob_pk'])
+        del entry['path']
@@ -1,29 +1,54 @@
 """Tasks that handle parsing e-mail.
 """
 
+import binascii
 import logging
 import json
+import re
 import subprocess
 import tempfile
 from pathlib import Path
 from collections import defaultdict
+from contextlib import ExitStack
 import email
+import email.parser
 import codecs
 import chardet
+from django.conf import settings
 from .. import models
 from ..tasks import snoop_task, SnoopTaskError, SnoopTaskBroken, require_dependency
 from ..tasks import returns_json_blob
+from . import html
 from . import tika
 from . import pgp
 
 BYTE_ORDER_MARK = b'\xef\xbb\xbf'
 
+TEXT_CONTENT_TYPES = {'text/plain', 'text/html'}
+"""Parts kept in memory while parsing, to extract their text."""
+
+MAX_LINE_LENGTH = 2 ** 16
+"""Longer lines are read in pieces, so a part without line breaks can't use up the memory."""
+
+PGP_SNIFF_SIZE = 2 ** 16
+"""Number of bytes from the start of each part that are checked for a PGP message."""
+
+BASE64_IGNORED = re.compile(rb'[^A-Za-z0-9+/=]')
+
+CHARSET_SAMPLE_SIZE = 2 ** 16
+"""Number of bytes from the start of a text part used to guess its charset."""
+
 OUTLOOK_POSSIBLE_MIME_TYPES = [
     'application/vnd.ms-outlook',
     'application/vnd.ms-office',
     'application/CDFV2',
 ]
 
+try:
+    import cchardet
+except ImportError:
+    cchardet = None
+
 log = logging.getLogger(__name__)
 
 
@@ -41,6 +66,49 @@ def lookup_other_encodings(name: str) -> codecs.CodecInfo:
 codecs.register(lookup_other_encodings)
 
 
+def strict_decode(data, charset):
+    """Returns the data decoded with the given charset, or `None` if it's unknown or doesn't fit the data."""
+
+    try:
+        return data.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        return None
+
+
+def decode_text(payload_bytes, declared_charset=None):
+    """Decodes the payload of a text part.
+
+    The charset declared in the MIME headers is used if the payload decodes cleanly with it; then we try
+    strict UTF-8. Only if both fail do we guess the charset from a sample of
+    [`CHARSET_SAMPLE_SIZE`][snoop.data.analyzers.email.CHARSET_SAMPLE_SIZE] bytes, with `cchardet` if it's
+    installed (it is much faster) or `chardet` otherwise.
+    """
+
+    for charset in filter(None, [declared_charset, 'utf-8']):
+        text = strict_decode(payload_bytes, charset)
+        if text is not None:
+            return text
+
+    detector = cchardet or chardet
+    charset = detector.detect(payload_bytes[:CHARSET_SAMPLE_SIZE]).get('encoding') or 'latin1'
+    try:
+        return payload_bytes.decode(charset, errors='replace')
+    except LookupError:
+        return payload_bytes.decode('latin1')
+
+
+def message_from_buffer(data, chunk_size=2 ** 16):
+    """Parse an email message from a bytes-like object, feeding it to the parser in chunks.
+
+    Gives the same result as `email.message_from_bytes()`, but works on a memoryview (like the one returned
+    by [snoop.data.models.Blob.mmap][]) without copying the whole message into a new byte string first.
+    """
+    parser = email.parser.BytesFeedParser()
+    for offset in range(0, len(data), chunk_size):
+        parser.feed(bytes(data[offset:offset + chunk_size]))
+    return parser.close()
+
+
 def iter_parts(message, numbers=[]):
     """Yields multipart messages into identifiable parts.
 
@@ -85,87 +153,325 @@ def get_headers(message):
     return dict(rv)
 
 
-def dump_part(message, depends_on):
-    """Recursive function to extract text and attachments from multipart email.
+class PayloadDecoder:
+    """Undoes the Content-Transfer-Encoding of a part, on data fed to it one line at a time.
 
+    Base64 data is decoded in groups of 4 characters, carrying the rest over to the next line;
+    quoted-printable is decoded line by line, carrying an escape cut in half by a long line being read in
+    pieces over to the next piece. Other encodings are passed through.
+    """
 
-    For `text/html` multipart fragments we use Tika to extract the text.
+    def __init__(self, encoding):
+        self.encoding = encoding.strip().lower()
+        self.pending = b''
+        self.padded = False
+
+    def decode(self, data):
+        if self.encoding == 'base64':
+            return self.decode_base64(data)
+        if self.encoding == 'quoted-printable':
+            return self.decode_qp(data)
+        return data
+
+    def decode_qp(self, data):
+        data = self.pending + data
+        self.pending = b''
+        if not data.endswith(b'\n'):
+            escape = data.rfind(b'=', len(data) - 2)
+            if escape != -1:
+                data, self.pending = data[:escape], data[escape:]
+        return binascii.a2b_qp(data)
+
+    def decode_base64(self, data):
+        """Decodes the complete groups of 4 characters, handling the padding like `binascii.a2b_base64`.
+
+        Padding only counts from the third character of a group on, and only when it fills up the group;
+        other `=` characters are ignored. After a group that was filled up with padding, the rest of the
+        part is ignored, like the `email` package does.
+        """
+        if self.padded:
+            return b''
+        data = self.pending + BASE64_IGNORED.sub(b'', data)
+        pad = data.find(b'=')
+        while pad != -1:
+            missing = 4 - pad % 4
+            run = len(data) - pad - len(data[pad:].lstrip(b'='))
+            if missing <= 2 and run >= missing:
+                self.padded = True
+                self.pending = b''
+                return binascii.a2b_base64(data[:pad] + b'=' * missing)
+            if pad + run == len(data) and missing <= 2:
+                # the padding may go on in the next line
+                break
+            data = data[:pad] + data[pad + run:]
+            pad = data.find(b'=', pad)
+
+        end = len(data) if pad == -1 else pad
+        cut = end - end % 4
+        self.pending = data[cut:]
+        return binascii.a2b_base64(data[:cut])
+
+    def finish(self):
+        """Returns whatever is left over at the end of the part."""
+
+        if self.encoding == 'quoted-printable':
+            pending, self.pending = self.pending, b''
+            return binascii.a2b_qp(pending)
+        pending, self.pending = self.pending.rstrip(b'='), b''
+        if not pending:
+            return b''
+        try:
+            return binascii.a2b_base64(pending + b'==')
+        except binascii.Error:
+            return b''
 
-    Args:
-        message: the multipart message.
-        depends_on: dict with dependent functions; passed from the task function here to order the Tika
-            processing (for text extraction) if needed.
-    """
-    rv = {'headers': get_headers(message)}
 
-    if message.is_multipart():
-        rv['parts'] = [
-            dump_part(part, depends_on)
-            for part in message.get_payload()
-        ]
-        return rv
+class StreamingParser:
+    """Parses a MIME message from a binary file, one line at a time.
 
-    content_type = message.get_content_type()
+    Gives the same structure as the `email` package would, without building the message tree in memory:
+    only the headers and the `text/plain` and `text/html` parts are kept. Attachments are decoded straight
+    into Blobs as they are read, and other parts are dropped. The first
+    [`PGP_SNIFF_SIZE`][snoop.data.analyzers.email.PGP_SNIFF_SIZE] bytes of every part are checked for an
+    encrypted PGP message, which is then kept and decrypted.
 
-    try:
-        payload_bytes = message.get_payload(decode=True)
-    except:  # noqa: E722
-        log.exception("Error getting email payload")
-        raise SnoopTaskBroken("Error getting payload", "email_get_payload")
-
-    if pgp.is_encrypted(payload_bytes):
-        payload_bytes = pgp.decrypt(payload_bytes)
-        rv['pgp'] = True
-
-    if content_type == 'text/plain':
-        result = chardet.detect(payload_bytes)
-        charset = result.get('encoding') or 'latin1'
-        rv['text'] = payload_bytes.decode(charset, errors='replace')
-
-    if content_type == 'text/html':
-        with models.Blob.create() as writer:
-            writer.write(payload_bytes)
-
-        rmeta_blob = require_dependency(
-            f'tika-html-{writer.blob.pk}', depends_on,
-            lambda: tika.rmeta.laterz(writer.blob),
-        )
+    Args:
+        f: the message, as a binary file
+        depends_on: dict with dependencies of the task; used to order Tika processing for HTML parts.
+    """
 
-        with rmeta_blob.open(encoding='utf8') as f:
-            rmeta_data = json.load(f)
-        rv['text'] = rmeta_data[0].get('X-TIKA:content', "")
+    def __init__(self, f, depends_on):
+        self.f = f
+        self.depends_on = depends_on
+        self.boundaries = []
+
+    def readline(self):
+        return self.f.readline(MAX_LINE_LENGTH)
+
+    def match_boundary(self, line):
+        """Checks if the line delimits one of the multiparts being parsed.
+
+        Returns:
+            `(boundary, is_closing)`, or `None` if this is not a delimiter line.
+        """
+        if not self.boundaries or not line.startswith(b'--'):
+            return None
+        line = line.rstrip()
+        for boundary in reversed(self.boundaries):
+            if line == b'--' + boundary:
+                return boundary, False
+            if line == b'--' + boundary + b'--':
+                return boundary, True
+        return None
 
-    if message.get_content_disposition():
-        raw_filename = message.get_filename()
-        if raw_filename:
-            filename = read_header(raw_filename)
+    def read_headers(self):
+        """Reads the header lines of a part.
+
+        Returns:
+            `(message, end)`: a `Message` with just the headers, and the line that ended the part, if it
+            ended before its body started (`b''` at the end of the file), or `None`.
+        """
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                end = b''
+                break
+            if self.match_boundary(line):
+                end = line
+                break
+            if line in (b'\n', b'\r\n'):
+                end = None
+                break
+            lines.append(line)
+        return email.parser.BytesHeaderParser().parsebytes(b''.join(lines)), end
+
+    def read_body(self, consume):
+        """Passes the body lines of a part to `consume`, until the part ends.
+
+        The line break before a delimiter line belongs to the delimiter, so each line is held back until the
+        next one is read. Inside a multipart, the line break at the end of the file is dropped too, like the
+        `email` package does when the closing delimiter is missing.
+
+        Returns:
+            bytes: the delimiter line that ended the part, or `b''` at the end of the file.
+        """
+        previous = None
+        while True:
+            line = self.readline()
+            if not line or self.match_boundary(line):
+                if previous is not None:
+                    if line or self.boundaries:
+                        previous = strip_line_break(previous)
+                    consume(previous)
+                return line
+            if previous is not None:
+                consume(previous)
+            previous = line
+
+    def skip_body(self):
+        return self.read_body(lambda line: None)
+
+    def parse(self):
+        """Parses the whole message.
+
+        Returns:
+            dict: the message structure, like [snoop.data.analyzers.email.parse][] returns it.
+        """
+        rv, _ = self.parse_part()
+        return rv
 
-            with models.Blob.create() as writer:
-                writer.write(payload_bytes)
+    def parse_part(self):
+        """Parses a part, with all its children.
+
+        Returns:
+            `(data, end)`: the part structure and the line that ended the part.
+        """
+        headers, end = self.read_headers()
+        rv = {'headers': get_headers(headers)}
+
+        boundary = headers.get_boundary()
+        if end is not None:
+            self.finish_leaf(headers, rv, b'', None)
+        elif headers.get_content_maintype() == 'multipart' and boundary:
+            rv['parts'], end = self.parse_multipart(boundary.encode('ascii', 'surrogateescape'))
+        elif headers.get_content_type() == 'message/rfc822':
+            part, end = self.parse_part()
+            rv['parts'] = [part]
+        else:
+            end = self.parse_leaf(headers, rv)
+        return rv, end
+
+    def parse_multipart(self, boundary):
+        """Parses the children of a multipart, skipping its preamble and epilogue."""
+
+        self.boundaries.append(boundary)
+        parts = []
+        end = self.skip_body()
+        while end and self.match_boundary(end) == (boundary, False):
+            part, end = self.parse_part()
+            parts.append(part)
+        closed = bool(end) and self.match_boundary(end) == (boundary, True)
+        self.boundaries.pop()
+
+        if closed:
+            end = self.skip_body()
+        return parts, end
+
+    def parse_leaf(self, headers, rv):
+        """Decodes the body of a part that has no children.
+
+        Returns:
+            bytes: the line that ended the part.
+        """
+        content_type = headers.get_content_type()
+        in_memory = content_type in TEXT_CONTENT_TYPES
+        decoder = PayloadDecoder(str(headers.get('Content-Transfer-Encoding', '')))
+        buffer = bytearray()
+        kept = True
+
+        with ExitStack() as stack:
+            writer = None
+            if not in_memory and get_attachment_name(headers):
+                writer = stack.enter_context(models.Blob.create())
+
+            def write(data):
+                nonlocal kept
+                if writer:
+                    writer.write(data)
+                if kept:
+                    buffer.extend(data)
+                    if not in_memory and len(buffer) >= PGP_SNIFF_SIZE and not pgp.is_encrypted(buffer):
+                        kept = False
+                        buffer.clear()
+
+            try:
+                end = self.read_body(lambda line: write(decoder.decode(line)))
+                write(decoder.finish())
+            except binascii.Error:
+                log.exception("Error decoding email payload")
+                raise SnoopTaskBroken("Error getting payload", "email_get_payload")
+
+        self.finish_leaf(headers, rv, bytes(buffer) if kept else None, writer and writer.blob)
+        return end
+
+    def finish_leaf(self, headers, rv, payload_bytes, blob):
+        """Extracts the text and attachment from a decoded part.
+
+        Args:
+            headers: the `Message` with the part headers
+            rv: the part structure, updated in place
+            payload_bytes: the decoded payload, if it was kept in memory
+            blob: the Blob the payload was written into, if any
+        """
+        content_type = headers.get_content_type()
+
+        if payload_bytes is not None and pgp.is_encrypted(payload_bytes):
+            payload_bytes = pgp.decrypt(payload_bytes)
+            rv['pgp'] = True
+            blob = None
+
+        if content_type == 'text/plain':
+            rv['text'] = decode_text(payload_bytes, headers.get_content_charset())
+
+        if content_type == 'text/html':
+            if settings.EMAIL_HTML_WITH_TIKA:
+                html_blob = models.Blob.create_from_bytes(payload_bytes)
+
+                rmeta_blob = require_dependency(
+                    f'tika-html-{html_blob.pk}', self.depends_on,
+                    lambda: tika.rmeta.laterz(html_blob),
+                )
+
+                with rmeta_blob.open(encoding='utf8') as f:
+                    rmeta_data = json.load(f)
+                rv['text'] = rmeta_data[0].get('X-TIKA:content', "")
+            else:
+                rv['text'] = html.html_to_text(decode_text(payload_bytes, headers.get_content_charset()))
+
+        filename = get_attachment_name(headers)
+        if filename:
+            if blob is None:
+                blob = models.Blob.create_from_bytes(payload_bytes)
 
             rv['attachment'] = {
                 'name': filename,
-                'blob_pk': writer.blob.pk,
+                'blob_pk': blob.pk,
             }
 
-    return rv
+
+def strip_line_break(line):
+    if line.endswith(b'\r\n'):
+        return line[:-2]
+    if line.endswith(b'\n'):
+        return line[:-1]
+    return line
+
+
+def get_attachment_name(headers):
+    """Returns the decoded file name of a part with a Content-Disposition header, or `None`."""
+
+    if headers.get_content_disposition():
+        raw_filename = headers.get_filename()
+        if raw_filename:
+            return read_header(raw_filename)
+    return None
 
 
 @snoop_task('email.parse', priority=3)
 @returns_json_blob
 def parse(blob, **depends_on):
-    """Task function to parse emails into a dict with its structure."""
-
-    with blob.open() as f:
-        message_bytes = f.read()
+    """Task function to parse emails into a dict with its structure.
 
-    if message_bytes[:3] == BYTE_ORDER_MARK:
-        message_bytes = message_bytes[3:]
+    The message is read by a [StreamingParser][snoop.data.analyzers.email.StreamingParser], so memory use
+    doesn't grow with the size of the attachments.
+    """
 
-    message = email.message_from_bytes(message_bytes)
-    data = dump_part(message, depends_on)
+    with blob.open() as f:
+        if f.read(len(BYTE_ORDER_MARK)) != BYTE_ORDER_MARK:
+            f.seek(0)
 
-    return data
+        return StreamingParser(f, depends_on).parse()
 
 
 @snoop_task('email.msg_to_eml', priority=2)
@@ -194,6 +500,6 @@ def parse_date(raw_date):
     """Parse the date format inside emails, returning `None` if failed."""
     try:
         return email.utils.parsedate_to_datetime(raw_date)
-    except TypeError as e:
+    except (TypeError, ValueError) as e:
         log.exception(f'error in parsing date: "{raw_date}"  {str(e)}')
         return None
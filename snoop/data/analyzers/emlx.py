@@ -1,15 +1,56 @@
 """Tasks that handle converting modern Apple-format e-mail into RFC-822 format e-mail.
 """
 
+import json
 import re
-import email
 import logging
+import uuid
+from hashlib import sha1
 from .. import models
-from ..tasks import snoop_task
-from .email import iter_parts
+from ..tasks import snoop_task, require_dependency
+from .email import iter_parts, message_from_buffer
 
 log = logging.getLogger(__name__)
 
+NEWLINES = re.compile(rb'\r\n|\r')
+
+COPY_CHUNK_SIZE = 2 ** 20
+
+
+def read_message(blob):
+    """Parses an `.emlx` file, skipping the first line that holds the message length."""
+
+    with blob.mmap() as original_data:
+        prefix = re.match(rb'\d+\s+', original_data)
+        offset = prefix.end() if prefix else 0
+        return message_from_buffer(original_data[offset:])
+
+
+def partial_parts(message):
+    """Yields the `(ref, part)` pairs for the parts whose payload was moved out into `.emlxpart` files."""
+
+    for ref, part in iter_parts(message):
+        if part.get('X-Apple-Content-Length'):
+            yield ref, part
+
+
+def copy_normalized(f, output):
+    """Copies a file into a BlobWriter, changing line endings to `\\n` as the `email` generator does."""
+
+    pending_cr = False
+    while True:
+        chunk = f.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if pending_cr:
+            chunk = b'\r' + chunk
+        pending_cr = chunk.endswith(b'\r')
+        if pending_cr:
+            chunk = chunk[:-1]
+        output.write(NEWLINES.sub(b'\n', chunk))
+    if pending_cr:
+        output.write(b'\n')
+
 
 @snoop_task('emlx.reconstruct', priority=2)
 def reconstruct(file_pk, **depends_on):
@@ -21,38 +62,69 @@ def reconstruct(file_pk, **depends_on):
     - it zeroes out larger parts inside the multipart message, and moves their payload to separate files on
         disk in the same directory, with the extension `.partial.emlx`.
 
-    This task reads all those `.partial.emlx` files and attaches them back to a new `.eml` email message to
-    be used with the rest of the pipeline.
+    This task finds all those `.partial.emlx` files with a single query, then depends on a
+    [snoop.data.analyzers.emlx.build][] Task that attaches them back to a new `.eml` email message to be used
+    with the rest of the pipeline. That Task is identified by the original Blob and the part Blobs, so the
+    message is only rebuilt if any of them changed.
     """
     from .. import filesystem  # noqa: F401
 
     file = models.File.objects.get(pk=file_pk)
-    with file.original.open() as f:
-        original_data = f.read()
+    names = {
+        re.sub(r'\.partial\.emlx$', f'.{ref}.emlxpart', file.name): ref
+        for ref, _ in partial_parts(read_message(file.original))
+    }
 
-    eml_data = re.sub(rb'^\d+\s+', b'', original_data, re.MULTILINE)
-    message = email.message_from_bytes(eml_data)
+    found = {
+        bytes(name_bytes): original_pk
+        for name_bytes, original_pk in (
+            file.parent_directory.child_file_set
+            .filter(name_bytes__in=[name.encode('utf8') for name in names])
+            .values_list('name_bytes', 'original')
+        )
+    }
 
-    for ref, part in iter_parts(message):
-        if part.get('X-Apple-Content-Length'):
-            ext = f'.{ref}.emlxpart'
-            part_name = re.sub(r'\.partial\.emlx$', ext, file.name)
-            parent = file.parent_directory
-            part_file = (
-                parent.child_file_set
-                .filter(name_bytes=part_name.encode('utf8'))
-                .first()
-            )
-
-            if not part_file:
-                log.warning("Missing %r", part_name)
-                continue
-
-            with part_file.original.open() as f:
-                payload = f.read()
-            part.set_payload(payload)
+    parts = []
+    for name, ref in names.items():
+        blob_pk = found.get(name.encode('utf8'))
+        if not blob_pk:
+            log.warning("Missing %r", name)
+            continue
+        parts.append([ref, blob_pk])
+
+    key = sha1(json.dumps([file.original.pk, parts]).encode('utf8')).hexdigest()
+    return require_dependency(
+        f'emlx_build_{key}', depends_on,
+        lambda: build.laterz(file.original, parts),
+    )
+
+
+@snoop_task('emlx.build', priority=2)
+def build(blob, parts):
+    """Task that writes the `.eml` message for an `.emlx` file and the payloads of its parts.
+
+    The message is generated with a unique marker in place of each missing payload; the payloads are then
+    copied from their Blobs into the output in between the generated pieces, so they are never held in
+    memory.
+
+    Args:
+        blob: the `.emlx` Blob
+        parts: list of `[ref, blob_pk]` pairs, with the Blob holding the payload for each part number
+    """
+
+    payloads = dict(parts)
+    marker = f'snoop-emlx-part-{uuid.uuid4().hex}'
+    message = read_message(blob)
+    for ref, part in partial_parts(message):
+        if ref in payloads:
+            part.set_payload(f'{marker}-{ref}-')
 
+    pieces = re.split(f'{marker}-([0-9.]+)-'.encode('ascii'), message.as_bytes())
     with models.Blob.create() as output:
-        output.write(message.as_bytes())
+        output.write(pieces[0])
+        for i in range(1, len(pieces), 2):
+            with models.Blob.objects.get(pk=payloads[pieces[i].decode('ascii')]).open() as f:
+                copy_normalized(f, output)
+            output.write(pieces[i + 1])
 
     return output.blob
@@ -1,10 +1,23 @@
-"""Tasks that sanitize HTML files before sending to front-end.
+"""Tasks that sanitize HTML files before sending to front-end, and extract text from HTML email parts.
 """
 
+import re
+from html.parser import HTMLParser
+
 import bleach
 
 HTML_MIME_TYPES = {'text/html', 'text/xml', 'application/xhtml+xml', 'application/xml'}
 
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template'}
+"""Elements whose content is not text."""
+
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption',
+    'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav',
+    'ol', 'p', 'pre', 'section', 'table', 'title', 'tr', 'ul',
+}
+"""Elements that start on a new line."""
+
 
 def is_html(blob):
     return blob.mime_type in HTML_MIME_TYPES
@@ -18,3 +31,56 @@ def clean(blob):
         html = f.read()
 
     return bleach.clean(html, strip=True, tags=ALLOWED_TAGS)
+
+
+class TextExtractor(HTMLParser):
+    """Collects the text of an HTML document, with line breaks around block elements."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+        self.pre = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag == 'pre':
+            self.pre += 1
+        if tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+        elif tag == 'td' or tag == 'th':
+            self.chunks.append('\t')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag == 'pre':
+            self.pre = max(0, self.pre - 1)
+        if tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if not self.pre:
+            data = re.sub(r'\s+', ' ', data)
+        self.chunks.append(data)
+
+    def text(self):
+        text = ''.join(self.chunks)
+        text = re.sub(r' *\n[ \t]*', '\n', text)
+        return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def html_to_text(html):
+    """Extracts the text from an HTML document, leaving out scripts and styles.
+
+    This runs in-process and is used for HTML email parts, instead of a round trip to Tika; see
+    [`EMAIL_HTML_WITH_TIKA`][snoop.defaultsettings.EMAIL_HTML_WITH_TIKA].
+    """
+
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
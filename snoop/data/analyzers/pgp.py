@@ -2,12 +2,164 @@
 
 Requires the passphrase be removed from the key and imported into the "gpghome" directory under the
 collection dataset root.
+
+Each worker process keeps one [GpgSession][snoop.data.analyzers.pgp.GpgSession] per collection: it starts
+the `gpg-agent` for the collection's "gpghome" once and keeps it running, so the secret keys are loaded only
+once. Recently decrypted payloads are remembered in a single cache for the whole process, keyed by the hash
+of the encrypted data.
 """
+import hashlib
+import logging
+import os
 import subprocess
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
 
 from .. import collections
 from ..tasks import SnoopTaskBroken
 
+log = logging.getLogger(__name__)
+
+GPG_BATCH_FLAGS = [
+    '--batch',
+    '--no-tty',
+    '--quiet',
+    '--no-auto-check-trustdb',
+    '--no-permission-warning',
+]
+"""Flags that keep `gpg` from prompting, printing or checking the trust database on every run."""
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_caches = {}
+
+
+class DecryptCache:
+    """LRU cache of decrypted payloads, holding up to `max_size` bytes in total.
+
+    One cache is shared by all the collections handled by a worker process; see
+    [snoop.data.analyzers.pgp.decrypt_cache][].
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def add(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+
+def decrypt_cache():
+    """Returns the DecryptCache for this worker process."""
+
+    key = os.getpid()
+    cache = _caches.get(key)
+    if cache is None:
+        with _sessions_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = DecryptCache(settings.PGP_DECRYPT_CACHE_SIZE)
+                _caches.clear()
+                _caches[key] = cache
+    return cache
+
+
+class GpgSession:
+    """Decrypts data with the keys in one "gpghome" directory, for the lifetime of a worker process.
+
+    The `gpg-agent` is launched the first time something is decrypted, and left running for the next
+    `gpg` processes to use. Decrypted payloads are kept in the process's
+    [DecryptCache][snoop.data.analyzers.pgp.DecryptCache], keyed by the "gpghome" and the SHA-256 of the
+    encrypted data, so the same message found in many places is only decrypted once.
+    """
+
+    def __init__(self, gpghome, cache):
+        self.gpghome = gpghome
+        self.cache = cache
+        self.agent_started = False
+
+    def start_agent(self):
+        """Launches the `gpg-agent` for this "gpghome", if it's not running already.
+
+        If the launch fails, it's tried again on the next decryption; `gpg` starts its own agent meanwhile.
+        """
+
+        result = subprocess.run(
+            ['gpgconf', '--homedir', str(self.gpghome), '--launch', 'gpg-agent'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if result.returncode:
+            log.warning('could not launch gpg-agent: %s', result.stdout.decode('latin1'))
+            return
+        self.agent_started = True
+
+    def decrypt(self, data):
+        """Returns the decrypted data, from the cache or by running `gpg --decrypt`."""
+
+        key = (str(self.gpghome), hashlib.sha256(data).hexdigest())
+        decrypted = self.cache.get(key)
+        if decrypted is not None:
+            return decrypted
+
+        if not self.agent_started:
+            self.start_agent()
+
+        result = subprocess.run(
+            ['gpg', '--home', self.gpghome, *GPG_BATCH_FLAGS, '--decrypt'],
+            input=bytes(data),
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        self.cache.add(key, result.stdout)
+        return result.stdout
+
+
+def gpg_session():
+    """Returns the GpgSession for the current collection and worker process.
+
+    Sessions are tied to the process that created them, so forked workers start their own, and drop the
+    ones inherited from their parent.
+    """
+
+    gpghome = collections.current().gpghome_path
+    if not gpghome.exists():
+        raise SnoopTaskBroken("No gpghome folder", 'gpg_not_configured')
+
+    pid = os.getpid()
+    key = (pid, collections.current().name)
+    session = _sessions.get(key)
+    if session is None:
+        cache = decrypt_cache()
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                for stale in [k for k in _sessions if k[0] != pid]:
+                    del _sessions[stale]
+                session = GpgSession(gpghome, cache)
+                _sessions[key] = session
+    return session
+
 
 def is_encrypted(data):
     """Checks if string data encodes PGP encrypted message.
@@ -20,19 +172,12 @@ def is_encrypted(data):
 
 
 def decrypt(data):
-    """Runs `gpg --decrypt` on the given data with the given collection `gpghome` dir."""
+    """Decrypts the given data with the current collection's `gpghome` keys.
 
-    gpghome = collections.current().gpghome_path
-    if not gpghome.exists():
-        raise SnoopTaskBroken("No gpghome folder", 'gpg_not_configured')
+    See [snoop.data.analyzers.pgp.GpgSession][].
+    """
 
-    result = subprocess.run(
-        ['gpg', '--home', gpghome, '--decrypt'],
-        input=data,
-        check=True,
-        stdout=subprocess.PIPE,
-    )
-    return result.stdout
+    return gpg_session().decrypt(data)
 
 
 def import_keys(keydata):
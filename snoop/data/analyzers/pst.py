@@ -0,0 +1,287 @@
+"""Tasks that read Outlook PST files in-process, one folder at a time.
+
+This is used instead of `readpst` (see [snoop.data.analyzers.archives.call_readpst][]) when the
+optional `pypff` module (from `libpff-python`) is installed and
+[`PST_NATIVE_READER`][snoop.defaultsettings.PST_NATIVE_READER] is set. The folders are listed first by
+[snoop.data.analyzers.pst.list_folders][], then the messages are extracted by many
+[snoop.data.analyzers.pst.extract_messages][] Tasks, each handling a range of messages from one folder.
+These Tasks run in parallel, write every message straight into a Blob, and are only run once each: if a
+worker dies halfway through a large PST, only the unfinished ranges are done again.
+"""
+
+from contextlib import contextmanager
+import base64
+import email.parser
+import email.policy
+import json
+import logging
+import re
+import uuid
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from django.conf import settings
+
+from .. import models
+from ..tasks import snoop_task, returns_json_blob, require_dependency, MissingDependency
+
+try:
+    import pypff
+except ImportError:
+    pypff = None
+
+log = logging.getLogger(__name__)
+
+PR_ATTACH_LONG_FILENAME = 0x3707
+PR_ATTACH_FILENAME = 0x3704
+
+ATTACHMENT_CHUNK_SIZE = 2 ** 20
+"""Size of the reads made from PST attachments."""
+
+BASE64_LINE_BYTES = 57
+"""Number of bytes encoded on each line of base64, 76 characters long."""
+
+SKIPPED_HEADERS = {'content-type', 'content-transfer-encoding', 'mime-version'}
+"""Headers from the original message that don't apply to the message we rebuild."""
+
+
+def can_read_natively():
+    """Returns True if PST files should be read with `pypff`."""
+
+    return pypff is not None and settings.PST_NATIVE_READER
+
+
+@contextmanager
+def open_pst(blob):
+    """Opens the PST file stored in the given Blob."""
+
+    pst_file = pypff.file()
+    pst_file.open(str(blob.path()))
+    try:
+        yield pst_file
+    finally:
+        pst_file.close()
+
+
+def get_folder(pst_file, index):
+    """Returns the folder found by following the sub-folder numbers in `index` (like "0/3/1")."""
+
+    folder = pst_file.get_root_folder()
+    for i in index.split('/') if index else []:
+        folder = folder.get_sub_folder(int(i))
+    return folder
+
+
+def safe_name(name):
+    """Turns a folder or attachment name into something usable as a File name."""
+
+    return (name or '').replace('/', '_').strip() or '_'
+
+
+def attachment_name(attachment, n):
+    """Returns the file name of an attachment, read from its MAPI properties."""
+
+    for record_set in getattr(attachment, 'record_sets', None) or []:
+        for entry in record_set.entries:
+            if entry.entry_type in (PR_ATTACH_LONG_FILENAME, PR_ATTACH_FILENAME):
+                try:
+                    name = entry.get_data_as_string()
+                except Exception:
+                    continue
+                if name:
+                    return safe_name(name)
+    return f'attachment-{n}'
+
+
+def decode_body(body):
+    if isinstance(body, bytes):
+        return body.decode('utf8', errors='replace')
+    return body or ''
+
+
+def attachment_chunks(attachment):
+    """Reads the data of an attachment in chunks of about
+    [`ATTACHMENT_CHUNK_SIZE`][snoop.data.analyzers.pst.ATTACHMENT_CHUNK_SIZE] bytes."""
+
+    remaining = attachment.get_size() or 0
+    while remaining > 0:
+        chunk = attachment.read_buffer(min(ATTACHMENT_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def write_base64(chunks, output):
+    """Writes the data as base64 lines of 76 characters, the way `email` encodes attachments."""
+
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk
+        cut = len(data) - len(data) % BASE64_LINE_BYTES
+        output.write(base64.encodebytes(data[:cut]))
+        pending = data[cut:]
+    output.write(base64.encodebytes(pending))
+
+
+def write_message(message, output):
+    """Writes an RFC-822 message rebuilt from a `pypff` message into a BlobWriter.
+
+    The message has the original headers, the bodies and the attachments. The headers and bodies are
+    generated by `email`, with a unique marker in place of each attachment's payload; the attachments are
+    then read from the PST in chunks and written out in between the generated pieces, so they are never held
+    in memory.
+    """
+
+    eml = MIMEMultipart('mixed')
+    headers = message.transport_headers
+    if headers:
+        parsed = email.parser.HeaderParser(policy=email.policy.compat32).parsestr(headers)
+        for key, value in parsed.items():
+            if key.lower() not in SKIPPED_HEADERS:
+                eml[key] = value
+    elif message.subject:
+        eml['Subject'] = message.subject
+
+    plain = decode_body(message.plain_text_body)
+    html = decode_body(message.html_body)
+    if plain and html:
+        body = MIMEMultipart('alternative')
+        body.attach(MIMEText(plain, 'plain', 'utf-8'))
+        body.attach(MIMEText(html, 'html', 'utf-8'))
+        eml.attach(body)
+    elif html:
+        eml.attach(MIMEText(html, 'html', 'utf-8'))
+    else:
+        eml.attach(MIMEText(plain, 'plain', 'utf-8'))
+
+    marker = f'snoop-pst-attachment-{uuid.uuid4().hex}'
+    for n in range(message.number_of_attachments):
+        name = attachment_name(message.get_attachment(n), n)
+        part = MIMEBase('application', 'octet-stream', Name=name)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part['Content-Disposition'] = f'attachment; filename="{name}"'
+        part.set_payload(f'{marker}-{n}-')
+        eml.attach(part)
+
+    pieces = re.split(f'{marker}-([0-9]+)-\n?'.encode('ascii'), eml.as_bytes(policy=email.policy.compat32))
+    output.write(pieces[0])
+    for i in range(1, len(pieces), 2):
+        write_base64(attachment_chunks(message.get_attachment(int(pieces[i]))), output)
+        output.write(pieces[i + 1])
+
+
+@snoop_task('pst.list_folders', priority=2)
+@returns_json_blob
+def list_folders(blob):
+    """Lists all the folders in a PST, with their paths and message counts.
+
+    Sibling folders with the same name (after [snoop.data.analyzers.pst.safe_name][]) get their sub-folder
+    number added to the name, so their messages don't overwrite each other in the listing.
+    """
+
+    def walk(folder, index, path):
+        yield {
+            'index': index,
+            'path': path,
+            'messages': folder.number_of_sub_messages,
+        }
+        taken = set()
+        for i in range(folder.number_of_sub_folders):
+            sub_folder = folder.get_sub_folder(i)
+            name = safe_name(sub_folder.name)
+            while name in taken:
+                name = f'{name}_{i}'
+            taken.add(name)
+            yield from walk(
+                sub_folder,
+                f'{index}/{i}' if index else str(i),
+                path + [name],
+            )
+
+    with open_pst(blob) as pst_file:
+        return list(walk(pst_file.get_root_folder(), '', []))
+
+
+@snoop_task('pst.extract_messages', priority=2)
+@returns_json_blob
+def extract_messages(blob, folder_index, start):
+    """Stores a range of messages from one PST folder as Blobs, returns their listing entries.
+
+    Handles up to [`PST_MESSAGES_PER_TASK`][snoop.defaultsettings.PST_MESSAGES_PER_TASK] messages, starting
+    with number `start`. The messages are named by their position in the folder, starting with `1.eml`,
+    like `readpst` does. The entries are yielded as the messages are stored, and written out by
+    [snoop.data.tasks.returns_json_blob][] one at a time.
+    """
+
+    from .archives import ExtractionBudget
+
+    budget = ExtractionBudget(blob.size)
+    with open_pst(blob) as pst_file:
+        folder = get_folder(pst_file, folder_index)
+        end = min(start + settings.PST_MESSAGES_PER_TASK, folder.number_of_sub_messages)
+        for n in range(start, end):
+            with models.Blob.create() as output:
+                write_message(folder.get_sub_message(n), output)
+            budget.add(members=1, size=output.size)
+            yield {
+                'type': 'file',
+                'name': f'{n + 1}.eml',
+                'blob_pk': output.blob.pk,
+                'size': output.size,
+            }
+
+
+def unpack(blob, depends_on, budget):
+    """Builds the archive listing for a PST from the results of the folder and message Tasks.
+
+    Called from [snoop.data.analyzers.archives.unarchive][] with its dependencies. All the missing
+    `extract_messages` Tasks are created, queued and added as dependencies at once, so the folder listing is
+    only read again after all of them are done. The messages of all the ranges are counted together in the
+    `budget` of the whole PST, since each `extract_messages` Task only checks its own range.
+
+    Returns:
+        list: the archive listing
+    """
+
+    from .archives import ListingBuilder
+
+    folders_blob = require_dependency('pst_folders', depends_on, lambda: list_folders.laterz(blob))
+    with folders_blob.open() as f:
+        folders = json.load(f)
+
+    ranges = [
+        (folder, start)
+        for folder in folders
+        for start in range(0, folder['messages'], settings.PST_MESSAGES_PER_TASK)
+    ]
+
+    def dependency_name(folder, start):
+        return f'pst_messages_{folder["index"]}_{start}'
+
+    missing = [
+        (folder, start) for folder, start in ranges
+        if dependency_name(folder, start) not in depends_on
+    ]
+    if missing:
+        log.info('queueing %s extraction tasks for %s folders in %s', len(missing), len(folders), blob)
+        tasks = [
+            (dependency_name(folder, start), extract_messages.laterz(blob, folder['index'], start))
+            for folder, start in missing
+        ]
+        raise MissingDependency(*tasks[0], others=tasks[1:])
+
+    builder = ListingBuilder()
+    for folder in folders:
+        builder.add_directory('/'.join(folder['path']))
+    for folder, start in ranges:
+        result = depends_on[dependency_name(folder, start)]
+        if isinstance(result, Exception):
+            raise result
+        with result.open() as f:
+            entries = json.load(f)
+        budget.add(members=len(entries), size=sum(entry['size'] for entry in entries))
+        for entry in entries:
+            builder.add_file('/'.join(folder['path'] + [entry['name']]), entry['blob_pk'])
+    return builder.listing()
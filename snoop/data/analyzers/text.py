@@ -11,7 +11,7 @@ from ..tasks import snoop_task
 @snoop_task('text.extract')
 def extract_text(blob):
     with models.Blob.create() as output:
-        with blob.open() as src:
-            output.write(src.read())
+        with blob.mmap() as src:
+            output.write(src)
 
     return output.blob
@@ -10,14 +10,37 @@ We keep a hard-coded list of what mime types to send to Tika. We should probably
 and let them surprise us instead.
 """
 
+import logging
+import os
+import random
+import re
+import threading
+import time
 from urllib.parse import urljoin
 from django.conf import settings
 import requests
+from requests.adapters import HTTPAdapter
 from dateutil import parser
-from ..tasks import snoop_task, SnoopTaskBroken, returns_json_blob
+from .. import models
+from ..tasks import snoop_task, SnoopTaskBroken
 from ..utils import zulu
 from snoop import tracing
 
+log = logging.getLogger(__name__)
+
+STATS_LOG_INTERVAL = 100
+"""Log the client counters after this many calls."""
+
+RESPONSE_CHUNK_SIZE = 2 ** 20
+"""Read Tika responses in chunks of this size when streaming them into Blobs."""
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pools = {}
+
+stats = {'calls': 0, 'errors': 0, 'seconds': 0.0}
+"""Counters for the Tika calls made by this process."""
+
 TIKA_MIME_TYPES = {
     'text/plain',
     'text/html',
@@ -65,38 +88,330 @@ def can_process(blob):
     return False
 
 
-def call_tika_server(endpoint, data, content_type):
+def tika_urls():
+    """Returns the Tika server URLs listed in [`SNOOP_TIKA_URL`][snoop.defaultsettings.SNOOP_TIKA_URL]."""
+
+    return [url.strip() for url in settings.SNOOP_TIKA_URL.split(',') if url.strip()]
+
+
+class TikaBackend:
+    """One Tika server, with the state used for balancing and health checks."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = None
+
+    def __str__(self):
+        return self.url
+
+
+class TikaPool:
+    """Balances calls between Tika servers, and stops using the ones that fail.
+
+    Each call goes to the server with the fewest requests in progress from this process (picking at random
+    between equals, so worker processes spread out). After
+    [`TIKA_MAX_FAILURES`][snoop.defaultsettings.TIKA_MAX_FAILURES] failures in a row, a server is ejected for
+    at least [`TIKA_EJECT_SECONDS`][snoop.defaultsettings.TIKA_EJECT_SECONDS]. Only connection errors and
+    `5xx` responses count as failures: a read timeout is blamed on the document, not on the server.
+
+    A background thread checks all the servers every
+    [`TIKA_HEALTH_CHECK_SECONDS`][snoop.defaultsettings.TIKA_HEALTH_CHECK_SECONDS] with a request to their
+    `/tika` endpoint: failed checks count like failed calls, and ejected servers are taken back once they
+    answer again.
+
+    If all servers are ejected, `requests.ConnectionError` is raised without making a call, which makes the
+    Task deferred instead of failed (see [snoop.data.tasks.run_task][]).
+    """
+
+    def __init__(self, urls):
+        self.backends = [TikaBackend(url) for url in urls]
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Picks a server for the next call, and counts the call as in progress."""
+
+        with self.lock:
+            healthy = [b for b in self.backends if b.ejected_until is None]
+            if not healthy:
+                raise requests.ConnectionError('all Tika servers are down')
+            least = min(b.outstanding for b in healthy)
+            backend = random.choice([b for b in healthy if b.outstanding == least])
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend, ok):
+        """Counts a call as finished; counts a failure if it's not `ok`."""
+
+        with self.lock:
+            backend.outstanding -= 1
+            self.record(backend, ok)
+
+    def record(self, backend, ok):
+        """Resets or increases the failure count of a server, ejecting it after too many failures in a row.
+
+        Must be called with the lock held.
+        """
+
+        if ok:
+            backend.failures = 0
+            return
+        backend.failures += 1
+        if backend.failures >= settings.TIKA_MAX_FAILURES and backend.ejected_until is None:
+            self.eject(backend)
+
+    def eject(self, backend):
+        log.warning('tika server %s is down, not using it for %ss', backend, settings.TIKA_EJECT_SECONDS)
+        backend.ejected_until = time.monotonic() + settings.TIKA_EJECT_SECONDS
+
+    def check_health(self, backend):
+        """Takes an ejected server back if it answers, or ejects it again.
+
+        Failed checks of the servers in use count like failed calls.
+        """
+
+        try:
+            resp = requests.get(urljoin(backend.url, 'tika'), timeout=settings.TIKA_CONNECT_TIMEOUT)
+            healthy = resp.status_code == 200
+        except requests.RequestException:
+            healthy = False
+
+        with self.lock:
+            if backend.ejected_until is None:
+                self.record(backend, healthy)
+            elif healthy:
+                log.info('tika server %s is back up', backend)
+                backend.ejected_until = None
+                backend.failures = 0
+            else:
+                self.eject(backend)
+
+    def check_all(self):
+        """Checks the servers that are in use, and the ejected ones that waited long enough."""
+
+        now = time.monotonic()
+        for backend in self.backends:
+            if backend.ejected_until is None or backend.ejected_until <= now:
+                self.check_health(backend)
+
+    def start_health_checks(self):
+        """Starts the background thread that runs [snoop.data.analyzers.tika.TikaPool.check_all][]."""
+
+        def run():
+            while True:
+                time.sleep(settings.TIKA_HEALTH_CHECK_SECONDS)
+                try:
+                    self.check_all()
+                except Exception as e:
+                    log.exception('tika health checks failed: %s', e)
+
+        threading.Thread(target=run, name='tika-health-checks', daemon=True).start()
+
+
+def tika_pool():
+    """Returns the TikaPool for this worker process."""
+
+    key = (os.getpid(), tuple(tika_urls()))
+    pool = _pools.get(key)
+    if pool is None:
+        with _sessions_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = TikaPool(key[1])
+                pool.start_health_checks()
+                _pools.clear()
+                _pools[key] = pool
+    return pool
+
+
+def tika_session():
+    """Returns the HTTP session used to talk to Tika from this worker process.
+
+    The session keeps up to [`TIKA_POOL_SIZE`][snoop.defaultsettings.TIKA_POOL_SIZE] keep-alive connections
+    open. Sessions are tied to the process that created them, so forked workers don't share sockets.
+    """
+
+    key = os.getpid()
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=len(tika_urls()),
+                    pool_maxsize=settings.TIKA_POOL_SIZE,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions.clear()
+                _sessions[key] = session
+    return session
+
+
+def count_call(duration, error):
+    """Updates the client counters, and logs them every few calls."""
+
+    stats['calls'] += 1
+    stats['errors'] += int(error)
+    stats['seconds'] += duration
+    if stats['calls'] % STATS_LOG_INTERVAL == 0:
+        log.info('tika client: %(calls)s calls, %(errors)s errors, %(seconds).1fs total', stats)
+
+
+def call_tika_server(endpoint, data, content_type, stream=False):
     """Executes HTTP PUT request to Tika server.
 
+    The server is picked by [snoop.data.analyzers.tika.TikaPool][]. If a server can't be reached, the call is
+    made again on another one, as long as the data can be rewound. Read timeouts are not retried.
+    Connections are reused between calls; see [snoop.data.analyzers.tika.tika_session][].
+
     Args:
-        endpoint: the endpoint to be appended to [snoop.defaultsettings.SNOOP_TIKA_URL][].
+        endpoint: the endpoint to be appended to the Tika server URL.
         data: the request object to be added to the PUT request
         content_type: content type detected by our libmagic implementation. If not supplied, Tika will run
             its own `libmagic` on it, and if that fails it will stop processing the request.
+        stream: if set, the response body is not read up front; the caller must read it and close the
+            response.
     """
-    session = requests.Session()
-    url = urljoin(settings.SNOOP_TIKA_URL, endpoint)
-    resp = session.put(url, data=data, headers={'Content-Type': content_type})
+    pool = tika_pool()
+    for attempt in range(len(pool.backends)):
+        backend = pool.acquire()
+        url = urljoin(backend.url, endpoint)
+        t0 = time.time()
+        try:
+            resp = tika_session().put(
+                url,
+                data=data,
+                headers={'Content-Type': content_type},
+                timeout=(settings.TIKA_CONNECT_TIMEOUT, settings.TIKA_READ_TIMEOUT),
+                stream=stream,
+            )
+        except requests.ConnectionError as e:
+            # includes ConnectTimeout, but not ReadTimeout: a document that takes too long to parse would
+            # take too long on any server
+            pool.release(backend, ok=False)
+            count_call(time.time() - t0, error=True)
+            if attempt + 1 < len(pool.backends) and hasattr(data, 'seek'):
+                log.warning('tika server %s failed (%r), trying another one', backend, e)
+                data.seek(0)
+                continue
+            raise
+        except requests.RequestException:
+            pool.release(backend, ok=True)
+            count_call(time.time() - t0, error=True)
+            raise
+
+        pool.release(backend, ok=resp.status_code < 500)
+        count_call(time.time() - t0, error=resp.status_code != 200)
+        break
 
     if resp.status_code == 422:
+        resp.close()
         raise SnoopTaskBroken("tika returned http 422, corrupt?", "tika_http_422")
 
     if (resp.status_code != 200
             or resp.headers['Content-Type'] != 'application/json'):
+        resp.close()
         raise RuntimeError(f"Unexpected response from tika: {resp}")
 
     return resp
 
 
+JSON_STRUCTURE_RE = re.compile(rb'[\\"\[\]{}]')
+"""Matches the bytes that [snoop.data.analyzers.tika.JsonStructure][] needs to look at."""
+
+
+class JsonStructure:
+    """Follows the brackets and strings of a JSON document fed to it in chunks, without parsing it.
+
+    This is enough to tell a complete document apart from one that was cut short, which is what we need when
+    copying Tika responses to disk: a truncated body always ends inside a string or with unclosed brackets.
+    """
+
+    CLOSERS = {ord('['): ord(']'), ord('{'): ord('}')}
+
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.valid = True
+
+    def feed(self, chunk):
+        """Updates the state with the next chunk of the document."""
+
+        pos = 0
+        if self.escaped and chunk:
+            self.escaped = False
+            pos = 1
+
+        while self.valid:
+            match = JSON_STRUCTURE_RE.search(chunk, pos)
+            if not match:
+                return
+            pos = match.end()
+            char = chunk[match.start()]
+
+            if self.in_string:
+                if char == ord('\\'):
+                    if pos == len(chunk):
+                        self.escaped = True
+                    pos += 1
+                elif char == ord('"'):
+                    self.in_string = False
+            elif char == ord('"'):
+                self.in_string = True
+            elif char == ord('\\'):
+                self.valid = False
+            elif char in self.CLOSERS:
+                if self.started and not self.stack:
+                    self.valid = False
+                self.started = True
+                self.stack.append(self.CLOSERS[char])
+            elif not self.stack or self.stack.pop() != char:
+                self.valid = False
+
+    @property
+    def complete(self):
+        """True if the document fed so far has its top level value closed, and nothing is left open."""
+
+        return self.valid and self.started and not self.stack and not self.in_string and not self.escaped
+
+
+def write_json_response(resp, output):
+    """Copies a JSON list response body into a BlobWriter, chunk by chunk.
+
+    The body is not parsed; we follow its brackets and strings with
+    [snoop.data.analyzers.tika.JsonStructure][] and check that it starts with `[` and has all of them
+    closed at the end, so that a response cut short by a dying server is not stored as a result.
+    """
+
+    structure = JsonStructure()
+    first = b''
+    for chunk in resp.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+        output.write(chunk)
+        structure.feed(chunk)
+        first = first or chunk.lstrip()[:1]
+
+    if first != b'[' or not structure.complete:
+        raise RuntimeError(f"Truncated or invalid JSON response from tika: {resp}")
+
+
 @snoop_task('tika.rmeta')
-@returns_json_blob
 def rmeta(blob):
-    """Task to run Tika on a given Blob."""
+    """Task to run Tika on a given Blob.
+
+    The JSON response is streamed straight into the result Blob, without being decoded and encoded again.
+    """
 
     with blob.open() as f, tracing.span('tika.rmeta'):
-        resp = call_tika_server('rmeta/text', f, blob.content_type)
+        resp = call_tika_server('rmeta/text', f, blob.content_type, stream=True)
+        with resp, models.Blob.create() as output:
+            write_json_response(resp, output)
 
-    return resp.json()
+    return output.blob
 
 
 def get_date_created(rmeta):
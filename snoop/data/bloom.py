@@ -0,0 +1,118 @@
+"""In-memory Bloom filter used to avoid database round-trips when checking if Blobs exist.
+
+The filter answers the question "was this key ever added?" with either "definitely not" or "maybe". A
+"definitely not" answer lets us skip the `SELECT` on the Blob table and go straight to writing the data; a
+"maybe" answer falls back to the usual database lookup. Since the filter can only err on the side of "maybe",
+using it never changes the results, only the number of queries made.
+
+Each worker process keeps one filter per collection, seeded from the Blob table the first time it's used and
+updated every time a Blob is saved. Blobs created by other workers after seeding are not visible in the
+filter; for those we rely on the final `get_or_create` in [snoop.data.models.Blob.create][] to de-duplicate.
+"""
+
+import logging
+import math
+import os
+import threading
+
+from django.conf import settings
+
+from . import collections
+
+log = logging.getLogger(__name__)
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter for hexadecimal hash keys.
+
+    Keys are expected to be hex digests of cryptographic hashes (like the Blob primary keys), so they're
+    already uniformly distributed: we slice the key itself to get the bit positions, instead of hashing it
+    again.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """Allocate the bit array.
+
+        Args:
+            capacity: expected number of keys; more keys can be added, with a higher false positive rate.
+            error_rate: desired false positive rate when `capacity` keys were added.
+        """
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        """Yields the bit positions for the given key, using double hashing."""
+        digest = bytes.fromhex(key[:32])
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        """Adds the key to the filter."""
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        """Returns False if the key was definitely never added, True if it might have been."""
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def _seed(blob_model):
+    """Creates a new filter and loads all the Blob primary keys from the current collection into it."""
+
+    count = blob_model.objects.count()
+    capacity = max(settings.BLOB_FILTER_CAPACITY, 2 * count)
+    bloom = BloomFilter(capacity, settings.BLOB_FILTER_ERROR_RATE)
+    for pk in blob_model.objects.values_list('pk', flat=True).iterator(chunk_size=10000):
+        bloom.add(pk)
+    log.info('seeded blob filter for collection %s with %s keys (%s KB)',
+             collections.current().name, bloom.count, len(bloom.bits) // 1024)
+    return bloom
+
+
+def blob_filter():
+    """Returns the Blob filter for the current collection, or `None` if the filter is disabled.
+
+    Filters are tied to the process that created them, so forked workers re-seed their own copy.
+    """
+
+    if not settings.BLOB_FILTER_ENABLED:
+        return None
+
+    from .models import Blob
+
+    key = (os.getpid(), collections.current().name)
+    bloom = _filters.get(key)
+    if bloom is None:
+        with _filters_lock:
+            bloom = _filters.get(key)
+            if bloom is None:
+                bloom = _seed(Blob)
+                _filters[key] = bloom
+    return bloom
+
+
+def might_exist(pk):
+    """Returns False if a Blob with the given primary key definitely doesn't exist in the current collection.
+    """
+
+    bloom = blob_filter()
+    if bloom is None:
+        return True
+    return pk in bloom
+
+
+def mark_existing(pk):
+    """Records that a Blob with the given primary key exists in the current collection."""
+
+    bloom = blob_filter()
+    if bloom is not None:
+        bloom.add(pk)
@@ -85,6 +85,7 @@ class Collection:
         self.ocr_languages = opt.get('ocr_languages', [])
         self.max_result_window = opt.get('max_result_window', 10000)
         self.refresh_interval = opt.get('refresh_interval', "5s")
+        self.extraction_limits = dict(settings.EXTRACTION_LIMITS, **opt.get('extraction_limits', {}))
 
         for lang_grp in self.ocr_languages:
             assert lang_grp.strip() != ''
@@ -30,6 +30,7 @@ from .analyzers import exif
 from . import ocr
 from ._file_types import FILE_TYPES
 from . import indexing
+from . import threads
 from snoop.data import language_detection
 
 log = logging.getLogger(__name__)
@@ -86,10 +87,9 @@ def gather(blob, **depends_on):
     rv = {'broken': []}
     text_blob = depends_on.get('text')
     if text_blob:
-        with text_blob.open() as f:
-            text_bytes = f.read()
         encoding = 'latin1' if blob.mime_encoding == 'binary' else blob.mime_encoding
-        rv['text'] = text_bytes.decode(encoding)
+        with text_blob.mmap() as text_bytes:
+            rv['text'] = str(text_bytes, encoding)
 
     # extract text and meta with apache tika
     tika_rmeta_blob = depends_on.get('tika_rmeta')
@@ -117,6 +117,15 @@ def gather(blob, **depends_on):
                 email_parse = json.load(f)
             rv['email'] = email_parse
 
+            headers = email_parse['headers']
+            raw_date = headers.get('Date', [None])[0]
+            threads.add_message(
+                blob, headers,
+                subject=headers.get('Subject', [''])[0],
+                sender=headers.get('From', [''])[0],
+                date=email.parse_date(raw_date) if raw_date else None,
+            )
+
     # combine OCR results
     ocr_results = dict(ocr.ocr_texts_for_blob(blob))
     if is_ocr_mime_type(blob.mime_type):
@@ -323,13 +332,10 @@ def full_path(file):
     `//` is used to mark files from inside containers (archives). This happens naturally when iterating
     objects, since all container files will contain a single directory with `name = ''`. See
     [snoop.data.models.Directory.container_file][] for more details.
+
+    The path is read from the stored [snoop.data.models.File.path_bytes][] column when available.
     """
-    node = file
-    elements = [file.name]
-    while node.parent:
-        node = node.parent
-        elements.append(node.name)
-    return '/'.join(reversed(elements))
+    return models.get_path_bytes(file).decode('utf8', errors='surrogateescape')
 
 
 def path_parts(path):
@@ -489,6 +495,10 @@ def email_meta(digest_data):
         'text': '\n\n'.join(text_bits).strip(),
         'pgp': pgp,
         'date': message_date,
+        'message-id': headers.get('Message-Id', [''])[0],
+        'in-reply-to': headers.get('In-Reply-To', []),
+        'references': headers.get('References', []),
+        'thread-index': headers.get('Thread-Index', [''])[0],
     }
 
 
@@ -582,6 +592,7 @@ def _get_document_content(digest, the_file=None):
 
     if the_file.blob.mime_type == 'message/rfc822':
         content.update(email_meta(digest_data))
+        content['thread'] = threads.get_thread_id(the_file.blob)
 
     if 'location' in digest_data:
         content['location'] = digest_data['location']
@@ -13,8 +13,18 @@ and others.
 """
 
 import json
+import hashlib
 import logging
+import os
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISDIR
+
 from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 
 from snoop.profiler import profile
 
@@ -24,15 +34,32 @@ from . import collections
 from .analyzers import archives
 from .analyzers import email
 from .analyzers import emlx
-from .tasks import snoop_task, require_dependency, remove_dependency, SnoopTaskBroken
+from .tasks import snoop_task, require_dependency, remove_dependency, retry_task, retry_tasks
+from .tasks import SnoopTaskBroken
 from .utils import time_from_unix
-from .indexing import delete_doc
+from .indexing import delete_doc, delete_docs
 
 log = logging.getLogger(__name__)
 
 RFC822_EMAIL_MIME_TYPES = {'message/rfc822', }
 EMLX_EMAIL_MIME_TYPES = {'message/x-emlx', }
 
+FILE_TASKS = [
+    'filesystem.handle_file',
+    'filesystem.create_archive_files',
+    'filesystem.create_attachment_files',
+    'emlx.reconstruct',
+]
+"""Tasks that take a File primary key as their first argument."""
+
+BULK_BATCH_SIZE = 2000
+"""Number of rows sent in a single query by `bulk_create()`."""
+
+
+def name_to_bytes(name):
+    """Encodes a file name found on disk the way it's stored in the `name_bytes` columns."""
+    return name.encode('utf8', errors='surrogateescape')
+
 
 def directory_absolute_path(directory):
     """Returns absolute Path for a dataset [snoop.data.models.Directory][].
@@ -47,17 +74,10 @@ def directory_absolute_path(directory):
         Throw exception if directory isn't directly on filesystem.
     """
 
-    path_elements = []
-    node = directory
-    col = collections.current()
-    path = col.data_path
-
-    while node.parent_directory:
-        path_elements.append(node.name)
-        node = node.parent_directory
-    for name in reversed(path_elements):
-        path /= name
-
+    path = collections.current().data_path
+    relative_path = models.get_path_bytes(directory).lstrip(b'/')
+    if relative_path:
+        path /= relative_path.decode('utf8', errors='surrogateescape')
     return path
 
 
@@ -66,12 +86,31 @@ def directory_absolute_path(directory):
 def walk(directory_pk):
     """Scans one level of a directory and recursively ingests all files and directories found.
 
-    Items are iterated in arbitrary order.  When a directory was found, an entry is added to the
-    [snoop.data.models.Directory][]. table (if it doesn't exist there already) and another
+    Items are iterated in the order of their names, as bytes.  When a directory was found, an entry is
+    added to the [snoop.data.models.Directory][]. table (if it doesn't exist there already) and another
     [snoop.data.filesystem.walk][] Task is queued on it. On the other hand, if a file was fonud, a
-    corresponding row is added (or updated, but never removed) from the [snoop.data.models.File][] table,
-    the binary data for the file is stored in a [snoop.data.models.Blob][] object, and finally the
-    [snoop.data.filesystem.handle_file][] Task is queued for it.
+    corresponding row is added (or updated) in the [snoop.data.models.File][] table, the binary data for the
+    file is stored in a [snoop.data.models.Blob][] object, and finally the
+    [snoop.data.filesystem.handle_file][] Task is queued for it. Files and directories that were found by a
+    previous run but are now gone from disk are removed by [snoop.data.filesystem.delete_vanished][].
+
+    When the modification time and the [fingerprint][snoop.data.filesystem.listing_fingerprint] of the
+    directory listing are the same as in the previous run, none of the entries changed since then and they
+    are not processed again. Child directories that have a different modification time than
+    the one recorded are walked again right away.
+
+    Directories with more than [`WALK_CHUNK_SIZE`][snoop.defaultsettings.WALK_CHUNK_SIZE] entries are
+    processed in chunks. This Task only lists the names, computes the fingerprint by looking at the entries
+    one at a time, and removes the vanished entries. It then stores the sorted names in a Blob and queues a
+    [snoop.data.filesystem.walk_chunk][] Task for each range of names, each committed separately. The
+    fingerprint is saved by [snoop.data.filesystem.finish_walk][], after all the chunks have finished, so a
+    directory is never pruned while some of its entries are missing.
+
+    The existing children are loaded with one query per table. Files that have the same size and
+    modification time as their stored rows are left alone; the others are hashed and copied into the blob
+    storage by [snoop.data.filesystem.ingest_files][], using a pool of
+    [`WALK_HASH_THREADS`][snoop.defaultsettings.WALK_HASH_THREADS] threads. New rows are created with bulk
+    inserts, from the Task's thread.
 
     One of the decorators of this function, [snoop.data.tasks.snoop_task][], wraps this function in a
     Django Transaction. Because [snoop.data.tasks.queue_task][] also wraps the queueing operation inside
@@ -103,45 +142,445 @@ def walk(directory_pk):
     directory = models.Directory.objects.get(pk=directory_pk)
     path = directory_absolute_path(directory)
 
-    for i, thing in enumerate(path.iterdir()):
-        queue_limit = i >= settings.CHILD_QUEUE_LIMIT
+    listing = []
+    dir_names = set()
+    with os.scandir(path) as it:
+        for entry in it:
+            name_bytes = name_to_bytes(entry.name)
+            listing.append(name_bytes)
+            if entry.is_dir():
+                dir_names.add(name_bytes)
+    listing.sort()
+    chunked = len(listing) > settings.WALK_CHUNK_SIZE
+
+    st_mtime = path.stat().st_mtime
+    mtime = time_from_unix(st_mtime)
+    children = {
+        bytes(name): (pk, child_mtime, fingerprint)
+        for name, pk, child_mtime, fingerprint in directory.child_directory_set.values_list(
+            'name_bytes', 'pk', 'mtime', 'fingerprint',
+        )
+    }
+    # large directories are only looked at one entry at a time here; the chunks stat their entries again
+    vanished = []
+    entries = stat_entries(path, listing, vanished)
+    if not chunked:
+        entries = list(entries)
+    fingerprint = listing_fingerprint(entries, children)
+    if vanished:
+        # deleted since the directory was listed; remove them from the database like the others
+        vanished = set(vanished)
+        listing = [name for name in listing if name not in vanished]
+        dir_names -= vanished
+
+    if directory.fingerprint and directory.mtime == mtime and directory.fingerprint == fingerprint:
+        log.info('walk: pruned unchanged subtree %s (%s entries)', directory, len(listing))
+        count_pruned_subtree(len(listing))
+        return
+
+    vanished_dirs = [pk for name, (pk, _, _) in children.items() if name not in dir_names]
+    vanished_files = [
+        pk for name, pk in directory.child_file_set.values_list('name_bytes', 'pk').iterator()
+        if bytes(name) in dir_names or not is_listed(listing, bytes(name))
+    ]
+    if vanished_dirs or vanished_files:
+        log.info('walk: %s directories and %s files removed from %s',
+                 len(vanished_dirs), len(vanished_files), directory)
+        delete_vanished(vanished_dirs, vanished_files)
+
+    if chunked:
+        queue_chunks(directory, listing, st_mtime, fingerprint)
+        return
+
+    walk_entries(directory, entries, children, known_file_map(directory.child_file_set.all()))
+    directory.mtime = mtime
+    directory.fingerprint = fingerprint
+    directory.save()
+
+
+def queue_chunks(directory, listing, st_mtime, fingerprint):
+    """Stores the sorted names of a large directory in a Blob and queues the Tasks that walk them in chunks.
+
+    Chunks that already succeeded with the same listing and fingerprint are not run again, and chunks that
+    failed are retried. [snoop.data.filesystem.finish_walk][] depends on all of them.
+    """
+    ranges = []
+    with models.Blob.create() as writer:
+        for start in range(0, len(listing), settings.WALK_CHUNK_SIZE):
+            data = b''.join(name + b'\0' for name in listing[start:start + settings.WALK_CHUNK_SIZE])
+            ranges.append((writer.size, len(data)))
+            writer.write(data)
+
+    log.info('walk: %s has %s entries, walking them in %s chunks', directory, len(listing), len(ranges))
+    chunks = {}
+    for i, (offset, length) in enumerate(ranges):
+        task = walk_chunk.laterz(
+            directory.pk, writer.blob.pk, offset, length, fingerprint,
+            queue_now=i < settings.CHILD_QUEUE_LIMIT,
+        )
+        if task.status in (models.Task.STATUS_ERROR, models.Task.STATUS_BROKEN):
+            retry_task(task)
+        chunks[f'chunk_{offset}'] = task
+
+    finish_walk.laterz(directory.pk, st_mtime, fingerprint, depends_on=chunks, retry=True)
+
+
+@snoop_task('filesystem.walk_chunk', priority=9)
+@profile()
+def walk_chunk(directory_pk, listing_pk, offset, length, fingerprint):
+    """Walks one range of the names of a large directory, stored by [snoop.data.filesystem.walk][].
+
+    Only the names in the range are read from the listing Blob, and only their rows are loaded from the
+    database. Entries that are gone since the listing was made are skipped; the next walk of the directory
+    will remove them.
+
+    Args:
+        directory_pk: the Directory being walked
+        listing_pk: the Blob with the sorted names, separated by null bytes
+        offset: position of the first name of the range in the Blob
+        length: size of the range, in bytes
+        fingerprint: the fingerprint of the directory computed when the listing was made
+    """
+    directory = models.Directory.objects.get(pk=directory_pk)
+    if directory.fingerprint == fingerprint:
+        log.info('walk: %s was already walked with this listing', directory)
+        return
+
+    path = directory_absolute_path(directory)
+    with models.Blob.objects.get(pk=listing_pk).open() as f:
+        f.seek(offset)
+        names = f.read(length).split(b'\0')[:-1]
+
+    entries = list(stat_entries(path, names))
+    children = {
+        bytes(name): (pk, child_mtime, child_fingerprint)
+        for name, pk, child_mtime, child_fingerprint in directory.child_directory_set.filter(
+            name_bytes__in=names,
+        ).values_list('name_bytes', 'pk', 'mtime', 'fingerprint')
+    }
+    known_files = known_file_map(directory.child_file_set.filter(name_bytes__in=names))
+    walk_entries(directory, entries, children, known_files)
+
+
+@snoop_task('filesystem.finish_walk', priority=9)
+def finish_walk(directory_pk, st_mtime, fingerprint, **chunks):
+    """Saves the modification time and fingerprint of a large directory, after all its chunks were walked.
+
+    If any chunk is broken, the fingerprint isn't saved, so the directory isn't pruned by the next walk.
+    """
+    for result in chunks.values():
+        if isinstance(result, Exception):
+            raise result
+
+    directory = models.Directory.objects.get(pk=directory_pk)
+    directory.mtime = time_from_unix(st_mtime)
+    directory.fingerprint = fingerprint
+    directory.save()
+
+
+def walk_entries(directory, entries, children, known_files):
+    """Creates, updates and queues the children of a directory for the given entries.
 
-        if thing.is_dir():
-            (child_directory, created) = directory.child_directory_set.get_or_create(
-                name_bytes=thing.name.encode('utf8', errors='surrogateescape'),
+    Args:
+        directory: the Directory being walked
+        entries: list of `(path, stat)` tuples, sorted by name
+        children: dict mapping the `name_bytes` of the known child directories to `(pk, mtime, fingerprint)`
+        known_files: dict returned by [snoop.data.filesystem.known_file_map][]
+    """
+    directory_path = models.get_path_bytes(directory)
+    new_dirs = []
+    changed_files = []
+    for i, (thing, stat) in enumerate(entries):
+        queue_limit = i >= settings.CHILD_QUEUE_LIMIT
+        name_bytes = name_to_bytes(thing.name)
+
+        if S_ISDIR(stat.st_mode):
+            if name_bytes in children:
+                (child_pk, child_mtime, _) = children[name_bytes]
+                # the listing of the child has changed since it was last walked, so go down there now;
+                # otherwise, the periodic sync will get to it in rotation
+                changed = child_mtime is not None and child_mtime != time_from_unix(stat.st_mtime)
+                walk.laterz(child_pk, retry=changed, queue_now=changed and not queue_limit)
+            else:
+                new_dirs.append(models.Directory(
+                    parent_directory=directory,
+                    name_bytes=name_bytes,
+                    path_bytes=directory_path + b'/' + name_bytes,
+                ))
+            continue
+
+        # if file is already loaded, and size+mtime are the same,
+        # don't hash it again and don't retry handle task
+        if name_bytes in known_files:
+            (file_pk, size, mtime) = known_files[name_bytes]
+            if size == stat.st_size and mtime == time_from_unix(stat.st_mtime):
+                handle_file.laterz(file_pk, queue_now=False)
+                continue
+        changed_files.append(thing)
+
+    models.Directory.objects.bulk_create(new_dirs, batch_size=BULK_BATCH_SIZE)
+    for i, child_directory in enumerate(new_dirs):
+        walk.laterz(child_directory.pk, queue_now=i < settings.CHILD_QUEUE_LIMIT)
+
+    new_files = []
+    for i, (thing, stat, original) in enumerate(ingest_files(changed_files)):
+        name_bytes = name_to_bytes(thing.name)
+        if name_bytes in known_files:
+            (file_pk, _, _) = known_files[name_bytes]
+            models.File.objects.filter(pk=file_pk).update(
+                mtime=time_from_unix(stat.st_mtime),
+                size=stat.st_size,
+                original=original,
+                date_modified=timezone.now(),
             )
-            # since the periodic task retries all talk tasks in rotation,
-            # we're not going to dispatch a walk task we didn't create
-            walk.laterz(child_directory.pk, queue_now=created and not queue_limit)
+            handle_file.laterz(file_pk, retry=True, queue_now=i < settings.CHILD_QUEUE_LIMIT)
+        else:
+            new_files.append(models.File(
+                parent_directory=directory,
+                name_bytes=name_bytes,
+                path_bytes=directory_path + b'/' + name_bytes,
+                ctime=time_from_unix(stat.st_ctime),
+                mtime=time_from_unix(stat.st_mtime),
+                size=stat.st_size,
+                original=original,
+                blob=original,
+            ))
+
+    models.File.objects.bulk_create(new_files, batch_size=BULK_BATCH_SIZE)
+    for i, file in enumerate(new_files):
+        handle_file.laterz(file.pk, retry=True, queue_now=i < settings.CHILD_QUEUE_LIMIT)
+
+    log.debug('walk: %s: %s new directories, %s new files, %s changed files',
+              directory, len(new_dirs), len(new_files), len(changed_files) - len(new_files))
+
+
+def known_file_map(queryset):
+    """Loads the name, primary key, size and modification time of the given Files with one query.
+
+    Returns:
+        dict: mapping `name_bytes` to `(pk, size, mtime)`
+    """
+    return {
+        bytes(name): (pk, size, mtime)
+        for name, pk, size, mtime in queryset.values_list('name_bytes', 'pk', 'size', 'mtime')
+    }
+
+
+def bytes_to_name(name_bytes):
+    """Decodes a `name_bytes` value back into the file name used on disk."""
+    return name_bytes.decode('utf8', errors='surrogateescape')
+
+
+def stat_entries(path, names, vanished=None):
+    """Yields `(path, stat)` for the given names in a directory, one at a time.
+
+    Entries that are gone from disk since the directory was listed are skipped.
+
+    Args:
+        path: the directory
+        names: the `name_bytes` of the entries
+        vanished: if set, a list where the names of the skipped entries are added
+    """
+    for name_bytes in names:
+        thing = path / bytes_to_name(name_bytes)
+        try:
+            stat = thing.stat()
+        except FileNotFoundError:
+            if vanished is not None:
+                vanished.append(name_bytes)
+            continue
+        yield thing, stat
+
+
+def is_listed(listing, name_bytes):
+    """Checks if a name is found in a sorted list of names."""
+    i = bisect_left(listing, name_bytes)
+    return i < len(listing) and listing[i] == name_bytes
+
+
+def delete_vanished(directory_pks, file_pks):
+    """Deletes Directories and Files that are gone from disk, along with everything found inside them.
+
+    Everything below the given rows (including the contents of archives and emails) is collected level by
+    level, then deleted from the database in one go through the `CASCADE` foreign keys. The Tasks that have
+    the deleted rows as arguments are deleted too.
+
+    Documents left without any File pointing to them are removed from the index with a single bulk request
+    (after the transaction commits), and their [Digests][snoop.data.models.Digest] and `digests.*` Tasks are
+    deleted, so they're processed again if they ever show up in another place. Their Blobs are kept, since
+    they may be referenced by other Tasks. Documents that are still found in other places are indexed again,
+    so the deleted paths and file names are dropped from them.
+
+    Args:
+        directory_pks: primary keys of the Directories to delete
+        file_pks: primary keys of the Files to delete
+    """
+    all_dirs = set(directory_pks)
+    all_files = set(file_pks)
+    new_dirs = set(all_dirs)
+    new_files = set(all_files)
+    while new_dirs or new_files:
+        child_files = set(
+            models.File.objects
+            .filter(parent_directory__in=new_dirs)
+            .values_list('pk', flat=True)
+        )
+        child_dirs = set(
+            models.Directory.objects
+            .filter(Q(parent_directory__in=new_dirs) | Q(container_file__in=new_files))
+            .values_list('pk', flat=True)
+        )
+        new_files = child_files - all_files
+        new_dirs = child_dirs - all_dirs
+        all_files |= new_files
+        all_dirs |= new_dirs
+
+    blob_pks = set(models.File.objects.filter(pk__in=all_files).values_list('blob', flat=True))
+
+    # these tasks only take the primary key, so they're found through the (func, args) unique index
+    models.Task.objects.filter(func='filesystem.walk', args__in=[[pk] for pk in all_dirs]).delete()
+    models.Task.objects.filter(func__in=FILE_TASKS, args__in=[[pk] for pk in all_files]).delete()
+    # the chunk tasks have more arguments, but they only exist for the few very large directories
+    (
+        models.Task.objects
+        .filter(func__in=['filesystem.walk_chunk', 'filesystem.finish_walk'])
+        .annotate(pkint=RawSQL("((args->0)::numeric)", ()))
+        .filter(pkint__in=list(all_dirs))
+        .delete()
+    )
+    models.Directory.objects.filter(pk__in=directory_pks).delete()
+    models.File.objects.filter(pk__in=file_pks).delete()
+
+    remaining = set(models.File.objects.filter(blob__in=blob_pks).values_list('blob', flat=True))
+    if remaining:
+        retry_tasks(
+            models.Task.objects
+            .filter(func='digests.index', blob_arg__in=remaining)
+            .exclude(status=models.Task.STATUS_PENDING)
+        )
 
+    orphans = blob_pks - remaining
+    if not orphans:
+        return
+
+    log.info('walk: removing %s orphaned documents from the index', len(orphans))
+    models.Digest.objects.filter(blob__in=orphans).delete()
+    models.Task.objects.filter(func__startswith='digests.', blob_arg__in=orphans).delete()
+    orphans = sorted(orphans)
+    transaction.on_commit(lambda: delete_docs(orphans), using=collections.current().db_alias)
+
+
+PRUNED_COUNT_QUERY = (
+    "INSERT INTO {table} (key, value) "
+    "VALUES ('walk', jsonb_build_object('pruned_directories', 1, 'pruned_entries', %s)) "
+    "ON CONFLICT (key) DO UPDATE SET value = {table}.value || jsonb_build_object("
+    "    'pruned_directories', COALESCE(({table}.value->>'pruned_directories')::bigint, 0) + 1, "
+    "    'pruned_entries', COALESCE(({table}.value->>'pruned_entries')::bigint, 0) + %s"
+    ")"
+)
+
+
+def count_pruned_subtree(entry_count):
+    """Adds a pruned directory to the counters kept in the `walk` row of [snoop.data.models.Statistics][].
+
+    The row is updated with a single upsert, so concurrent `walk` Tasks don't overwrite each other's counts.
+    The counters are reported together with the collection stats; see [snoop.data.admin.get_stats][].
+    """
+    query = PRUNED_COUNT_QUERY.format(table=models.Statistics._meta.db_table)
+    with connections[collections.current().db_alias].cursor() as cursor:
+        cursor.execute(query, [entry_count, entry_count])
+
+
+def listing_fingerprint(entries, children):
+    """Computes the fingerprint of a directory listing, to find out if anything changed since the last walk.
+
+    The fingerprint is a SHA1 hash over the entries: the names, sizes and modification times of files,
+    and the names, modification times and stored fingerprints of directories. The fingerprints of the child
+    directories are the ones saved by their own walks, so this doesn't go down the tree: a change deeper down
+    shows up here only after the walk of the child directory that saw it has finished.
+
+    Args:
+        entries: iterable of `(path, stat)` tuples for the directory entries, sorted by name
+        children: dict mapping the `name_bytes` of the known child directories to `(pk, mtime, fingerprint)`
+
+    Returns:
+        string: the hex digest
+    """
+    h = hashlib.sha1()
+    for thing, stat in entries:
+        name_bytes = name_to_bytes(thing.name)
+        if S_ISDIR(stat.st_mode):
+            child_fingerprint = children.get(name_bytes, (None, None, ''))[2]
+            h.update(b'd %s %d %s\0' % (name_bytes, stat.st_mtime_ns, child_fingerprint.encode('ascii')))
         else:
-            directory = models.Directory.objects.get(pk=directory_pk)
-            path = directory_absolute_path(directory) / thing.name
-            stat = path.stat()
-
-            original = models.Blob.create_from_file(path)
-            file, created = directory.child_file_set.get_or_create(
-                name_bytes=thing.name.encode('utf8', errors='surrogateescape'),
-                defaults=dict(
-                    ctime=time_from_unix(stat.st_ctime),
-                    mtime=time_from_unix(stat.st_mtime),
-                    size=stat.st_size,
-                    original=original,
-                    blob=original,
-                ),
-            )
-            # if file is already loaded, and size+mtime are the same,
-            # don't retry handle task
-            if created \
-                    or file.mtime != time_from_unix(stat.st_mtime) \
-                    or file.size != stat.st_size:
-                file.mtime = time_from_unix(stat.st_mtime)
-                file.size = stat.st_size
-                file.original = original
-                file.save()
-                handle_file.laterz(file.pk, retry=True, queue_now=not queue_limit)
-            else:
-                handle_file.laterz(file.pk, queue_now=False)
+            h.update(b'f %s %d %d\0' % (name_bytes, stat.st_size, stat.st_mtime_ns))
+    return h.hexdigest()
+
+
+def thread_map(func, items, threads=None):
+    """Runs `func` on all the items using a pool of threads, returning the results in the same order.
+
+    The worker threads have the current collection set, but they don't share the caller's database
+    connection, so `func` should only do I/O.
+
+    Args:
+        func: function called with each item
+        items: list of arguments
+        threads: size of the pool, defaults to
+            [`WALK_HASH_THREADS`][snoop.defaultsettings.WALK_HASH_THREADS]
+    """
+    if threads is None:
+        threads = settings.WALK_HASH_THREADS
+    threads = min(threads, len(items))
+    if threads <= 1:
+        return [func(item) for item in items]
+
+    col = collections.current()
+
+    def run(item):
+        with col.set_current():
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(run, items))
+
+
+def _stat_and_hash(path):
+    return path.stat(), models.file_sha3_256(path)
+
+
+def ingest_files(paths, threads=None):
+    """Stores the given files as [Blobs][snoop.data.models.Blob], hashing and copying them in parallel.
+
+    First all the files are hashed, then the ones not already stored are copied into the blob storage; both
+    steps use [snoop.data.filesystem.thread_map][]. Database queries and writes are done from the calling
+    thread, in bulk where possible.
+
+    Args:
+        paths: list of Path objects for files on disk
+        threads: number of threads, see `thread_map()`
+
+    Returns:
+        list: tuples of `(path, stat, blob)`, in the same order as the given paths.
+    """
+    hashed = thread_map(_stat_and_hash, paths, threads)
+    pks = [pk for (_, pk) in hashed]
+    blobs = models.Blob.objects.in_bulk(models.Blob.existing_pks(pks))
+
+    # copy each new blob only once, even if it shows up under multiple names
+    missing = {}
+    for path, pk in zip(paths, pks):
+        if pk not in blobs:
+            missing.setdefault(pk, path)
+    # a file may change after being hashed, so use whatever blob was actually copied for it
+    stored = thread_map(models.store_file, list(missing.values()), threads)
+    for pk, fields in zip(missing, stored):
+        blobs[pk] = models.Blob.from_stored(fields)
+
+    return [
+        (path, stat, blobs[pk])
+        for path, (stat, pk) in zip(paths, hashed)
+    ]
 
 
 @snoop_task('filesystem.handle_file', priority=1)
@@ -246,6 +685,14 @@ def create_archive_files(file_pk, archive_listing):
     This function serves half the role of [`walk()`][snoop.data.filesystem.walk], but inside archives; it
     queues [`handle_file()`][snoop.data.filesystem.handle_file] for all files unpacked. It assumes the
     `Blob` objects for the files inside have already been created.
+
+    Archives nested deeper than the `max_depth` [extraction limit][snoop.defaultsettings.EXTRACTION_LIMITS]
+    are not unpacked, and this Task is marked as broken with reason `archive_nesting_limit` (see
+    [snoop.data.analyzers.archives.check_nesting_depth][]).
+
+    All the Blobs are fetched up front, and the rows are created with bulk inserts, one directory level at a
+    time (see [snoop.data.filesystem.create_child_files][]), so the number of queries doesn't grow with the
+    number of files in a directory.
     """
 
     if isinstance(archive_listing, SnoopTaskBroken):
@@ -255,43 +702,108 @@ def create_archive_files(file_pk, archive_listing):
     with archive_listing.open() as f:
         archive_listing_data = json.load(f)
 
+    def iter_blob_pks(children):
+        for item in children:
+            if item['type'] == 'file':
+                yield item['blob_pk']
+            if item['type'] == 'directory':
+                yield from iter_blob_pks(item['children'])
+
     def create_directory_children(directory, children):
-        for i, item in enumerate(children):
-            queue_limit = i >= settings.CHILD_QUEUE_LIMIT
+        files = [item for item in children if item['type'] == 'file']
+        dirs = [item for item in children if item['type'] == 'directory']
+
+        file_map = create_child_files(directory, [
+            (item['name'].encode('utf8', errors='surrogateescape'), blobs[item['blob_pk']])
+            for item in files
+        ], archive.ctime, archive.mtime)
+        for i, file in enumerate(file_map.values()):
+            handle_file.laterz(file.pk, queue_now=i < settings.CHILD_QUEUE_LIMIT)
+
+        dir_map = create_child_directories(directory, [
+            item['name'].encode('utf8', errors='surrogateescape')
+            for item in dirs
+        ])
+        for item in dirs:
+            name_bytes = item['name'].encode('utf8', errors='surrogateescape')
+            create_directory_children(dir_map[name_bytes], item['children'])
 
-            if item['type'] == 'file':
-                child_original = models.Blob.objects.get(pk=item['blob_pk'])
-                file = create_file(directory, item['name'], child_original)
-                handle_file.laterz(file.pk, queue_now=not queue_limit)
+    archive = models.File.objects.get(pk=file_pk)
+    # the archive may have been extracted for a copy of it found higher up
+    archives.check_nesting_depth([archive])
 
-            if item['type'] == 'directory':
-                create_directory(directory, item['name'], item['children'])
+    blobs = models.Blob.get_many(iter_blob_pks(archive_listing_data))
+    (fake_root, _) = archive.child_directory_set.get_or_create(name_bytes=b'')
+    create_directory_children(fake_root, archive_listing_data)
 
-    def create_directory(parent_directory, name, children):
-        (directory, _) = parent_directory.child_directory_set.get_or_create(
-            name_bytes=name.encode('utf8', errors='surrogateescape'),
-        )
-        create_directory_children(directory, children)
 
-    def create_file(parent_directory, name, original):
-        size = original.path().stat().st_size
+def create_child_directories(parent_directory, names):
+    """Makes sure the Directory has child Directories with the given names, using bulk inserts.
 
-        file, _ = parent_directory.child_file_set.get_or_create(
-            name_bytes=name.encode('utf8', errors='surrogateescape'),
-            defaults=dict(
-                ctime=archive.ctime,
-                mtime=archive.mtime,
-                size=size,
-                original=original,
-                blob=original,
-            ),
-        )
+    Existing children are loaded with a single query; the missing ones are created with their
+    [`path_bytes`][snoop.data.models.Directory.path_bytes] already set, since `bulk_create()` doesn't call
+    `save()`.
 
-        return file
+    Args:
+        parent_directory: the [snoop.data.models.Directory][] to create children for
+        names: list of `name_bytes`
 
-    archive = models.File.objects.get(pk=file_pk)
-    (fake_root, _) = archive.child_directory_set.get_or_create(name_bytes=b'')
-    create_directory_children(fake_root, archive_listing_data)
+    Returns:
+        dict: mapping each of the given names to its Directory
+    """
+    existing = {
+        bytes(d.name_bytes): d
+        for d in parent_directory.child_directory_set.all()
+    }
+    parent_path = models.get_path_bytes(parent_directory)
+    new = {}
+    for name_bytes in names:
+        if name_bytes not in existing and name_bytes not in new:
+            new[name_bytes] = models.Directory(
+                parent_directory=parent_directory,
+                name_bytes=name_bytes,
+                path_bytes=parent_path + b'/' + name_bytes,
+            )
+    models.Directory.objects.bulk_create(new.values(), batch_size=BULK_BATCH_SIZE)
+    existing.update(new)
+    return {name_bytes: existing[name_bytes] for name_bytes in names}
+
+
+def create_child_files(parent_directory, items, ctime, mtime):
+    """Makes sure the Directory has child Files with the given names, using bulk inserts.
+
+    Existing Files are left untouched, like with `get_or_create()`. The sizes are taken from the Blobs.
+
+    Args:
+        parent_directory: the [snoop.data.models.Directory][] to create children for
+        items: list of `(name_bytes, blob)` tuples
+        ctime: creation time set on new Files
+        mtime: modification time set on new Files
+
+    Returns:
+        dict: mapping each of the given names to its File, in the order they were given
+    """
+    existing = {
+        bytes(f.name_bytes): f
+        for f in parent_directory.child_file_set.all()
+    }
+    parent_path = models.get_path_bytes(parent_directory)
+    new = {}
+    for name_bytes, blob in items:
+        if name_bytes not in existing and name_bytes not in new:
+            new[name_bytes] = models.File(
+                parent_directory=parent_directory,
+                name_bytes=name_bytes,
+                path_bytes=parent_path + b'/' + name_bytes,
+                ctime=ctime,
+                mtime=mtime,
+                size=blob.size,
+                original=blob,
+                blob=blob,
+            )
+    models.File.objects.bulk_create(new.values(), batch_size=BULK_BATCH_SIZE)
+    existing.update(new)
+    return {name_bytes: existing[name_bytes] for name_bytes, _ in items}
 
 
 def get_email_attachments(parsed_email):
@@ -335,23 +847,11 @@ def create_attachment_files(file_pk, email_parse):
         (attachments_dir, _) = email_file.child_directory_set.get_or_create(
             name_bytes=b'',
         )
-        for attachment in attachments:
-            original = models.Blob.objects.get(pk=attachment['blob_pk'])
-            size = original.path().stat().st_size
-
-            name_bytes = (
-                attachment['name']
-                .encode('utf8', errors='surrogateescape')
-            )
-            (file, _) = attachments_dir.child_file_set.get_or_create(
-                name_bytes=name_bytes,
-                defaults=dict(
-                    ctime=email_file.ctime,
-                    mtime=email_file.mtime,
-                    size=size,
-                    original=original,
-                    blob=original,
-                ),
-            )
+        blobs = models.Blob.get_many(attachment['blob_pk'] for attachment in attachments)
+        file_map = create_child_files(attachments_dir, [
+            (attachment['name'].encode('utf8', errors='surrogateescape'), blobs[attachment['blob_pk']])
+            for attachment in attachments
+        ], email_file.ctime, email_file.mtime)
 
+        for file in file_map.values():
             handle_file.laterz(file.pk)
@@ -48,6 +48,7 @@ MAPPINGS = {
             "sha1": {"type": "keyword"},
             "size": {"type": "integer"},
             "suffix": {"type": "keyword"},
+            "thread": {"type": "keyword"},
             "thread-index": {"type": "keyword"},
             "word-count": {"type": "integer"},
             "ocr": {"type": "boolean"},
@@ -131,6 +132,26 @@ def delete_doc(id):
     check_response(resp)
 
 
+def delete_docs(ids):
+    """Deletes multiple documents from the current collection, with a single bulk request.
+
+    Documents that are not found in the index are ignored.
+    """
+    if not ids:
+        return
+    es_index = collections.current().es_index
+    lines = [
+        json.dumps({'delete': {'_index': es_index, '_type': DOCUMENT_TYPE, '_id': id}})
+        for id in ids
+    ]
+    resp = requests.post(
+        f'{ES_URL}/_bulk',
+        data='\n'.join(lines) + '\n',
+        headers={'Content-Type': 'application/x-ndjson'},
+    )
+    check_response(resp)
+
+
 def delete_index_by_name(name):
     """Delete a whole Elasticsearch index."""
 
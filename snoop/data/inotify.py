@@ -0,0 +1,119 @@
+"""Minimal Linux `inotify` bindings, loaded from libc with `ctypes`.
+
+Only what [snoop.data.management.commands.watchsync][] needs: create an instance, add and remove watches
+and read batches of events with a timeout.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+"""Events that change the listing of a directory, or the size and modification time of its files."""
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify:
+    """An `inotify` instance.
+
+    Events are returned as `(wd, mask, cookie, name)` tuples, where `name` is the file name inside the
+    watched directory, as bytes (empty for events on the directory itself).
+    """
+
+    def __init__(self):
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Starts watching a path, returns the watch descriptor.
+
+        Args:
+            path: filesystem path, as string or bytes
+            mask: the events to watch for
+        """
+        if isinstance(path, str):
+            path = os.fsencode(path)
+        return _check(_get_libc().inotify_add_watch(self.fd, ctypes.c_char_p(path), ctypes.c_uint32(mask)))
+
+    def rm_watch(self, wd):
+        """Stops watching, ignoring watches that were already removed by the kernel."""
+        try:
+            _check(_get_libc().inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+
+    def read_events(self, timeout=None):
+        """Waits for events, then returns all that are available.
+
+        Args:
+            timeout: seconds to wait for the first event, or `None` to wait forever.
+
+        Returns:
+            list: `(wd, mask, cookie, name)` tuples; empty if the timeout expired.
+        """
+        if not self.poll.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+
+        try:
+            data = os.read(self.fd, 2 ** 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
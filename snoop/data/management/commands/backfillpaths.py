@@ -0,0 +1,102 @@
+"""Fill in the materialized paths of Directories and Files created before they were stored.
+
+The paths are stored in [snoop.data.models.Directory.path_bytes][] and [snoop.data.models.File.path_bytes][]
+and are set automatically for new rows. For existing collections this command computes them top-down, going
+through each table in ranges of primary keys of fixed size; each range is updated in its own transaction,
+so the command can be stopped and restarted at any point. Since parents are usually created before their
+children, most rows are filled in by the first pass; the passes are repeated until nothing changes.
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from ...logs import logging_for_management_command
+from ... import collections
+
+log = logging.getLogger(__name__)
+
+ROOT_SQL = """
+    UPDATE data_directory SET path_bytes = %s
+    WHERE path_bytes IS NULL
+        AND parent_directory_id IS NULL
+        AND container_file_id IS NULL
+"""
+
+CHILD_SQL = """
+    UPDATE {child_table} AS child
+    SET path_bytes = parent.path_bytes || %s || child.name_bytes
+    FROM {parent_table} AS parent
+    WHERE child.{parent_column} = parent.id
+        AND child.id >= %s AND child.id < %s
+        AND child.path_bytes IS NULL
+        AND parent.path_bytes IS NOT NULL
+"""
+
+MAX_ID_SQL = "SELECT COALESCE(MAX(id), 0) FROM {table}"
+
+STEPS = [
+    ('directories in directories', 'data_directory', 'data_directory', 'parent_directory_id'),
+    ('directories in files', 'data_directory', 'data_file', 'container_file_id'),
+    ('files in directories', 'data_file', 'data_directory', 'parent_directory_id'),
+]
+
+
+def backfill(col, batch_size):
+    """Runs batched updates on the collection database until no more paths can be filled in.
+
+    Returns:
+        int: number of rows updated.
+    """
+    total = 0
+    with transaction.atomic(using=col.db_alias), connections[col.db_alias].cursor() as cursor:
+        cursor.execute(ROOT_SQL, [b''])
+        total += cursor.rowcount
+
+    progress = True
+    while progress:
+        progress = False
+        for description, child_table, parent_table, parent_column in STEPS:
+            sql = CHILD_SQL.format(
+                child_table=child_table,
+                parent_table=parent_table,
+                parent_column=parent_column,
+            )
+            with connections[col.db_alias].cursor() as cursor:
+                cursor.execute(MAX_ID_SQL.format(table=child_table))
+                [max_id] = cursor.fetchone()
+            for start in range(0, max_id + 1, batch_size):
+                with transaction.atomic(using=col.db_alias), connections[col.db_alias].cursor() as cursor:
+                    cursor.execute(sql, [b'/', start, start + batch_size])
+                    count = cursor.rowcount
+                if not count:
+                    continue
+                progress = True
+                total += count
+                log.info('collection %s: filled in paths for %s %s (%s total)',
+                         col.name, count, description, total)
+    return total
+
+
+class Command(BaseCommand):
+    """Fill in missing materialized paths for Directories and Files."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection_names', type=str, nargs='+',
+                            help="set to ALL to run on all collections")
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help="Number of primary keys updated in a single transaction")
+
+    def handle(self, collection_names, batch_size, **options):
+        logging_for_management_command(options['verbosity'])
+
+        if 'ALL' in collection_names:
+            cols = list(collections.ALL.values())
+        else:
+            cols = [collections.ALL[name] for name in collection_names]
+
+        for col in cols:
+            with col.set_current():
+                total = backfill(col, batch_size)
+            log.info('collection %s: done, %s paths filled in', col.name, total)
@@ -20,6 +20,6 @@ class Command(BaseCommand):
         logging_for_management_command()
 
         if options['blob_id']:
-            with models.Blob.objects.get(pk=options['blob_id']).open() as f:
-                sys.stdout.buffer.write(f.read())
+            with models.Blob.objects.get(pk=options['blob_id']).mmap() as data:
+                sys.stdout.buffer.write(data)
                 sys.stdout.flush()
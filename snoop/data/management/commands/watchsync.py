@@ -0,0 +1,182 @@
+"""Watch a collection's dataset for changes and re-walk only the directories that changed.
+
+This is an alternative to the periodic sync done by [snoop.data.tasks.dispatch_for][] (which retries walk
+Tasks in rotation): an `inotify` watch is set on every directory under the collection's `data_path`, and
+when a directory's listing or one of its files changes, its [snoop.data.filesystem.walk][] Task is retried.
+The walk then takes care of queueing [snoop.data.filesystem.handle_file][] for the files that changed and
+walks for new sub-directories.
+
+Events are collected for a few seconds before queueing anything, so a burst of writes to the same
+directory results in a single walk. If the kernel event queue overflows, events were lost, so we fall back
+to retrying all the walk Tasks of the collection, like a full sync does.
+
+Linux only. Every directory uses up one watch, so the `fs.inotify.max_user_watches` sysctl may need to be
+raised for large datasets; directories that can't be watched are logged and left to the periodic sync.
+"""
+
+import errno
+import logging
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...logs import logging_for_management_command
+from ... import collections
+from ... import filesystem
+from ... import inotify
+from ... import models
+from ... import tasks
+
+log = logging.getLogger(__name__)
+
+
+def parent_path(path_bytes):
+    """Returns the path of the parent directory, in the format of `path_bytes`."""
+    return path_bytes.rsplit(b'/', 1)[0]
+
+
+def find_directory(path_bytes):
+    """Returns the Directory at the given path, or the closest ancestor that exists in the database.
+
+    Directories that are new on disk may not have been found by a walk yet; walking their closest known
+    ancestor will create them.
+    """
+    while path_bytes:
+        directory = models.Directory.objects.filter(path_bytes=path_bytes).first()
+        if directory:
+            return directory
+        path_bytes = parent_path(path_bytes)
+    return models.Directory.root()
+
+
+class Watcher:
+    """Keeps the `inotify` watches for a collection and turns events into walk Tasks."""
+
+    def __init__(self, collection, debounce):
+        self.collection = collection
+        self.debounce = debounce
+        self.root = os.fsencode(str(collection.data_path))
+        self.inotify = None
+        self.paths = {}
+        self.pending = set()
+        self.first_event = None
+        self.last_event = None
+
+    def start(self):
+        """Sets up a new `inotify` instance and watches on the whole tree."""
+        if self.inotify:
+            self.inotify.close()
+        self.inotify = inotify.Inotify()
+        self.paths = {}
+        self.watch_tree(b'')
+        log.info('collection %s: watching %s directories', self.collection.name, len(self.paths))
+
+    def watch_tree(self, path_bytes):
+        """Adds watches on the directory at the given path and all directories under it."""
+        for dirpath, dirnames, _ in os.walk(self.root + path_bytes):
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    log.warning('inotify watch limit reached, not watching %r and below', dirpath)
+                    dirnames.clear()
+                    continue
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            self.paths[wd] = dirpath[len(self.root):]
+
+    def handle_events(self, events):
+        """Records the directories that changed; returns False if events were lost."""
+        for wd, mask, _, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                return False
+
+            path_bytes = self.paths.get(wd)
+            if path_bytes is None:
+                continue
+
+            if mask & inotify.IN_IGNORED:
+                del self.paths[wd]
+                continue
+
+            if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                self.pending.add(parent_path(path_bytes))
+                continue
+
+            if mask & inotify.IN_ISDIR and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.watch_tree(path_bytes + b'/' + name)
+
+            self.pending.add(path_bytes)
+
+        now = time.monotonic()
+        if events:
+            self.first_event = self.first_event or now
+            self.last_event = now
+        return True
+
+    def due(self):
+        """Returns True if the pending directories should be walked now.
+
+        We wait until no events came for `debounce` seconds, but no more than 10 times that in total.
+        """
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return (now - self.last_event >= self.debounce
+                or now - self.first_event >= 10 * self.debounce)
+
+    def flush(self):
+        """Retries the walk Tasks for all the pending directories."""
+        paths = sorted(self.pending)
+        self.pending = set()
+        self.first_event = self.last_event = None
+
+        with transaction.atomic(using=self.collection.db_alias):
+            directory_pks = {find_directory(path_bytes).pk for path_bytes in paths}
+            for pk in directory_pks:
+                filesystem.walk.laterz(pk, retry=True)
+        log.info('collection %s: %s directories changed, retried %s walks',
+                 self.collection.name, len(paths), len(directory_pks))
+
+    def rescan(self):
+        """Falls back to retrying all the walk Tasks, and sets up the watches again."""
+        log.warning('collection %s: inotify queue overflow, rescanning everything', self.collection.name)
+        self.pending = set()
+        self.first_event = self.last_event = None
+        self.start()
+        tasks.retry_tasks(
+            models.Task.objects
+            .filter(func='filesystem.walk')
+            .exclude(status=models.Task.STATUS_PENDING)
+            .order_by('date_modified')
+        )
+
+    def run(self):
+        """Processes events until interrupted."""
+        self.start()
+        while True:
+            events = self.inotify.read_events(timeout=self.debounce)
+            if not self.handle_events(events):
+                self.rescan()
+                continue
+            if self.due():
+                self.flush()
+
+
+class Command(BaseCommand):
+    "Watch the dataset of a collection and re-walk directories as soon as they change."
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=str)
+        parser.add_argument('--debounce', type=float, default=5.0,
+                            help="Seconds to wait for more events before queueing walks")
+
+    def handle(self, collection, debounce, **options):
+        logging_for_management_command(options['verbosity'])
+
+        col = collections.ALL[collection]
+        with col.set_current():
+            Watcher(col, debounce).run()
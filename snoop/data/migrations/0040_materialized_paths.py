@@ -0,0 +1,32 @@
+# Generated by Django 3.1.4 on 2021-03-02 10:12
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0039_auto_20210204_2125'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='directory',
+            name='path_bytes',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='path_bytes',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='directory',
+            index=django.contrib.postgres.indexes.HashIndex(fields=['path_bytes'], name='data_directory_path_hash'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=django.contrib.postgres.indexes.HashIndex(fields=['path_bytes'], name='data_file_path_hash'),
+        ),
+    ]
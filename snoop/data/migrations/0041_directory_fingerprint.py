@@ -0,0 +1,23 @@
+# Generated by Django 3.1.4 on 2021-03-04 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0040_materialized_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='directory',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='directory',
+            name='mtime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.4 on 2021-03-11 10:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0041_directory_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=998, unique=True)),
+                ('thread_id', models.IntegerField(db_index=True, null=True)),
+                ('subject', models.TextField(blank=True, default='')),
+                ('sender', models.TextField(blank=True, default='')),
+                ('date', models.DateTimeField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('blob', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                                           related_name='+', to='data.blob')),
+            ],
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.1.4 on 2021-03-18 09:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_message_id_rows(apps, schema_editor):
+    """Adds the row without a blob for every Message-ID that only had a row for its email."""
+    db_alias = schema_editor.connection.alias
+    ThreadMessage = apps.get_model('data', 'ThreadMessage')
+    ThreadMessage.objects.using(db_alias).bulk_create(
+        [
+            ThreadMessage(message_id=message_id, thread_id=thread_id)
+            for message_id, thread_id in (
+                ThreadMessage.objects.using(db_alias)
+                .filter(blob__isnull=False)
+                .values_list('message_id', 'thread_id')
+            )
+        ],
+        batch_size=2000,
+    )
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0042_threadmessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='threadmessage',
+            name='message_id',
+            field=models.CharField(max_length=998),
+        ),
+        migrations.AlterField(
+            model_name='threadmessage',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='+', to='data.blob'),
+        ),
+        migrations.RunPython(add_message_id_rows, noop),
+        migrations.AddConstraint(
+            model_name='threadmessage',
+            constraint=models.UniqueConstraint(condition=models.Q(blob__isnull=True), fields=('message_id',),
+                                               name='unique_thread_message_id'),
+        ),
+        migrations.AddConstraint(
+            model_name='threadmessage',
+            constraint=models.UniqueConstraint(fields=('message_id', 'blob'), name='unique_thread_message_blob'),
+        ),
+    ]
@@ -5,6 +5,7 @@ databases.
 """
 
 import string
+import mmap
 from contextlib import contextmanager
 from pathlib import Path
 import tempfile
@@ -13,9 +14,11 @@ from django.db import models
 from django.conf import settings
 from django.template.defaultfilters import truncatechars
 from django.db.models import JSONField
+from django.contrib.postgres.indexes import HashIndex
 from django.core.exceptions import ObjectDoesNotExist
 from .magic import Magic
 
+from . import bloom
 from . import collections
 
 
@@ -28,6 +31,19 @@ def blob_repo_path(sha3_256):
     return collections.current().blob_root / sha3_256[:2] / sha3_256[2:4] / sha3_256[4:]
 
 
+def file_sha3_256(path):
+    """Returns the SHA3-256 hex digest of the file at the given path, reading it in chunks.
+
+    Args:
+        path: string or Path to read from
+    """
+    sha3_256 = hashlib.sha3_256()
+    with open(path, 'rb') as f:
+        for block in chunks(f):
+            sha3_256.update(block)
+    return sha3_256.hexdigest()
+
+
 def chunks(file, blocksize=65536):
     """Splits file into binary chunks of fixed size.
 
@@ -42,6 +58,43 @@ def chunks(file, blocksize=65536):
         yield data
 
 
+def store_file(path):
+    """Copies a file on disk into the blob storage, without touching the database.
+
+    This only does I/O, so it's safe to run from threads other than the one holding the Task's database
+    connection, as long as they have the collection set with
+    [snoop.data.collections.Collection.set_current][].
+    Use [snoop.data.models.Blob.from_stored][] to get the Blob object afterwards.
+
+    Args:
+        path: string or Path to read from
+
+    Returns:
+        dict: the Blob fields, including `sha3_256`
+    """
+    blob_tmp = collections.current().tmp_dir
+    blob_tmp.mkdir(exist_ok=True, parents=True)
+
+    with tempfile.NamedTemporaryFile(dir=blob_tmp, delete=False) as f:
+        writer = BlobWriter(f)
+        with open(path, 'rb') as src:
+            for block in chunks(src):
+                writer.write(block)
+
+    fields = writer.finish()
+    blob_path = blob_repo_path(fields['sha3_256'])
+    temp_blob_path = Path(f.name)
+    if blob_path.exists():
+        temp_blob_path.unlink()
+    else:
+        blob_path.parent.mkdir(exist_ok=True, parents=True)
+        temp_blob_path.chmod(0o444)
+        temp_blob_path.rename(blob_path)
+
+    fields.update(Magic(path).fields)
+    return fields
+
+
 class BlobWriter:
     """Compute binary blob size and hashes while also writing it in a file.
     """
@@ -167,33 +220,43 @@ class Blob(models.Model):
         Yields:
             [snoop.data.models.BlobWriter][] -- Use `.write(byte_string)` on the returned object until
             finished. The final result can be found at `.blob` on the same object, after exiting this
-            contextmanager's context.
+            contextmanager's context. If the context exits with an exception, the data written so far is
+            deleted.
         """
         blob_tmp = collections.current().tmp_dir
         blob_tmp.mkdir(exist_ok=True, parents=True)
 
-        fields = {}
-        if fs_path:
-            m = Magic(fs_path)
-            fields = m.fields
         with tempfile.NamedTemporaryFile(dir=blob_tmp, delete=False) as f:
             writer = BlobWriter(f)
-            yield writer
+            try:
+                yield writer
+            except BaseException:
+                Path(f.name).unlink()
+                raise
 
-        fields.update(writer.finish())
+        fields = writer.finish()
         pk = fields.pop('sha3_256')
 
         blob_path = blob_repo_path(pk)
-        blob_path.parent.mkdir(exist_ok=True, parents=True)
         temp_blob_path = Path(f.name)
+
+        # if we already have this one, skip the rename and the magic
+        if bloom.might_exist(pk):
+            existing = cls.objects.filter(pk=pk).first()
+            if existing and blob_path.exists():
+                temp_blob_path.unlink()
+                writer.blob = existing
+                return
+
+        blob_path.parent.mkdir(exist_ok=True, parents=True)
         temp_blob_path.chmod(0o444)
         temp_blob_path.rename(blob_path)
 
-        if not fs_path:
-            m = Magic(blob_path)
-            fields.update(m.fields)
+        m = Magic(fs_path or blob_path)
+        fields.update(m.fields)
 
         (blob, _) = cls.objects.get_or_create(pk=pk, defaults=fields)
+        bloom.mark_existing(pk)
         writer.blob = blob
 
     def _do_update_magic(self, path):
@@ -244,15 +307,17 @@ class Blob(models.Model):
         """
         sha3_256 = hashlib.sha3_256()
         sha3_256.update(data)
+        pk = sha3_256.hexdigest()
 
-        try:
-            b = Blob.objects.get(pk=sha3_256.hexdigest())
-            return b
+        if bloom.might_exist(pk):
+            try:
+                return Blob.objects.get(pk=pk)
+            except ObjectDoesNotExist:
+                pass
 
-        except ObjectDoesNotExist:
-            with cls.create() as writer:
-                writer.write(data)
-            return writer.blob
+        with cls.create() as writer:
+            writer.write(data)
+        return writer.blob
 
     @classmethod
     def create_from_file(cls, path):
@@ -267,22 +332,76 @@ class Blob(models.Model):
             path: string or Path to read from
         """
         path = Path(path).resolve().absolute()
-        file_sha3_256 = hashlib.sha3_256()
-        with open(path, 'rb') as f:
-            for block in chunks(f):
-                file_sha3_256.update(block)
+        pk = file_sha3_256(path)
+
+        if bloom.might_exist(pk):
+            try:
+                return Blob.objects.get(pk=pk)
+            except ObjectDoesNotExist:
+                pass
 
-        try:
-            b = Blob.objects.get(pk=file_sha3_256.hexdigest())
-            return b
+        return cls.copy_from_file(path)
 
-        except ObjectDoesNotExist:
-            with cls.create(path) as writer:
-                with open(path, 'rb') as f:
-                    for block in chunks(f):
-                        writer.write(block)
+    @classmethod
+    def copy_from_file(cls, path):
+        """Create a Blob from a file on disk, without checking if it exists first.
 
-            return writer.blob
+        Args:
+            path: string or Path to read from
+        """
+        with cls.create(path) as writer:
+            with open(path, 'rb') as f:
+                for block in chunks(f):
+                    writer.write(block)
+
+        return writer.blob
+
+    @classmethod
+    def from_stored(cls, fields):
+        """Returns the Blob for data already copied with [snoop.data.models.store_file][], creating the row.
+
+        Args:
+            fields: dict returned by `store_file()`
+        """
+        fields = dict(fields)
+        pk = fields.pop('sha3_256')
+        (blob, _) = cls.objects.get_or_create(pk=pk, defaults=fields)
+        bloom.mark_existing(pk)
+        return blob
+
+    @classmethod
+    def get_many(cls, pks, batch_size=2000):
+        """Returns a dict mapping primary keys to Blobs, fetched with one query per batch.
+
+        Keys without a Blob are missing from the result.
+
+        Args:
+            pks: iterable of SHA3-256 hashes
+            batch_size: maximum number of keys sent in a single query
+        """
+        pks = list(set(pks))
+        blobs = {}
+        for i in range(0, len(pks), batch_size):
+            blobs.update(cls.objects.in_bulk(pks[i:i + batch_size]))
+        return blobs
+
+    @classmethod
+    def existing_pks(cls, pks, batch_size=2000):
+        """Returns the subset of the given primary keys that have a Blob in the database.
+
+        Keys that the [Blob filter][snoop.data.bloom] knows are missing are not sent to the database at
+        all; the rest are checked with one query per batch.
+
+        Args:
+            pks: iterable of SHA3-256 hashes
+            batch_size: maximum number of keys sent in a single query
+        """
+        candidates = [pk for pk in set(pks) if bloom.might_exist(pk)]
+        found = set()
+        for i in range(0, len(candidates), batch_size):
+            batch = candidates[i:i + batch_size]
+            found.update(cls.objects.filter(pk__in=batch).values_list('pk', flat=True))
+        return found
 
     def open(self, encoding=None):
         """Open this Blob's data storage for reading.
@@ -297,6 +416,52 @@ class Blob(models.Model):
             mode = 'r'
         return self.path().open(mode, encoding=encoding)
 
+    @contextmanager
+    def mmap(self):
+        """Map this Blob's data storage in memory, for reading.
+
+        The data is paged in by the kernel as it's accessed and shared with the page cache, so large Blobs
+        can be parsed without holding a second copy of them in the worker's memory. The view (and any slices
+        taken from it) must not be used after exiting the context.
+
+        Yields:
+            memoryview: read-only view over the whole Blob content.
+        """
+        with self.open() as f:
+            if not self.path().stat().st_size:
+                # empty files can't be mapped
+                yield memoryview(b'')
+                return
+
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+                try:
+                    mapped.close()
+                except BufferError:
+                    # slices of the view still exist; the map is closed when they're collected
+                    pass
+
+
+def get_path_bytes(item):
+    """Returns the full path of a File or Directory relative to the collection root, as bytes.
+
+    Uses the stored `path_bytes` column when set; for rows created before that column existed (and not yet
+    backfilled by [snoop.data.management.commands.backfillpaths][]), the path is computed by walking up the
+    parents, one query per level.
+
+    `//` marks the inside of container files (archives, emails), like in [snoop.data.digests.full_path][].
+    """
+    if item.path_bytes is not None:
+        return bytes(item.path_bytes)
+    parent = item.parent
+    if parent is None:
+        return b''
+    return get_path_bytes(parent) + b'/' + bytes(item.name_bytes)
+
 
 class Directory(models.Model):
     """Database model for a file directory.
@@ -335,12 +500,42 @@ class Directory(models.Model):
     Mutually exclusive with [snoop.data.models.Directory.parent_directory][].
     """
 
+    path_bytes = models.BinaryField(null=True, blank=True)
+    """Full path of this Directory, relative to the collection root, as bytes.
+
+    Set from the parent's path when the row is first saved, so it never needs to be computed by walking up
+    the tree. See [snoop.data.models.get_path_bytes][] for the format.
+    """
+
+    mtime = models.DateTimeField(null=True, blank=True)
+    """Modification time of the directory on disk, as seen by the last
+    [snoop.data.filesystem.walk][]. NULL for directories that are not on disk (inside archives, emails).
+    """
+
+    fingerprint = models.CharField(max_length=40, blank=True, default='')
+    """Hash of the directory listing seen by the last [snoop.data.filesystem.walk][].
+
+    Covers the names, sizes and modification times of the entries, and the stored fingerprints of the child
+    directories. See [snoop.data.filesystem.listing_fingerprint][].
+    """
+
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('parent_directory', 'name_bytes')
         verbose_name_plural = 'directories'
+        indexes = [
+            # for looking up directories by their path, which can be too long for a btree
+            HashIndex(fields=['path_bytes'], name='data_directory_path_hash'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Override for setting the materialized path on insert."""
+
+        if self.path_bytes is None:
+            self.path_bytes = get_path_bytes(self)
+        super().save(*args, **kwargs)
 
     @classmethod
     def root(cls):
@@ -374,6 +569,9 @@ class Directory(models.Model):
 
     def ancestry(item):
         """Yields ancestors until root is found.
+
+        This runs one query per level; use [snoop.data.models.get_path_bytes][] if only the names are
+        needed.
         """
         while item:
             yield item
@@ -382,7 +580,7 @@ class Directory(models.Model):
     def __str__(self):
         """String representation for this Directory is its full path.
         """
-        return ''.join(reversed([f'{item.name}/' for item in self.ancestry()]))
+        return get_path_bytes(self).decode('utf8', errors='surrogateescape') + '/'
 
     __repr__ = __str__
 
@@ -431,11 +629,28 @@ class File(models.Model):
     prefixed to it).
     """
 
+    path_bytes = models.BinaryField(null=True, blank=True)
+    """Full path of this File, relative to the collection root, as bytes.
+
+    Set from the parent's path when the row is first saved. See [snoop.data.models.get_path_bytes][] for the
+    format.
+    """
+
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('parent_directory', 'name_bytes')
+        indexes = [
+            HashIndex(fields=['path_bytes'], name='data_file_path_hash'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Override for setting the materialized path on insert."""
+
+        if self.path_bytes is None:
+            self.path_bytes = get_path_bytes(self)
+        super().save(*args, **kwargs)
 
     @property
     def name(self):
@@ -806,6 +1021,47 @@ class DocumentUserTag(models.Model):
         digests.retry_index(self.blob)
 
 
+class ThreadMessage(models.Model):
+    """An email message, placed in a conversation thread.
+
+    Rows are added by [snoop.data.threads.add_message][] for every email we digest, and for every message
+    those emails refer to. Each Message-ID has one row without a `blob`, used to link the threads together;
+    each email we have with that Message-ID gets its own row, since the same message is often found in more
+    than one mailbox.
+    """
+
+    message_id = models.CharField(max_length=998)
+    """Normalized Message-ID; see [snoop.data.threads.normalize_message_id][]."""
+
+    thread_id = models.IntegerField(null=True, db_index=True)
+    """Identifier shared by all the messages in a thread: the primary key of its oldest row."""
+
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    """An email with this Message-ID, or `None` for the row that stands for the Message-ID itself."""
+
+    subject = models.TextField(blank=True, default='')
+    sender = models.TextField(blank=True, default='')
+    date = models.DateTimeField(null=True, blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['message_id'],
+                condition=models.Q(blob__isnull=True),
+                name='unique_thread_message_id',
+            ),
+            models.UniqueConstraint(fields=['message_id', 'blob'], name='unique_thread_message_blob'),
+        ]
+
+    def __str__(self):
+        return f'{self.message_id} (thread {self.thread_id})'
+
+    __repr__ = __str__
+
+
 class OcrSource(models.Model):
     """Database model for a directory on disk containing External OCR files.
     """
@@ -26,6 +26,7 @@ import logging
 from time import time, sleep
 from datetime import timedelta
 from functools import wraps
+from collections.abc import Iterator
 
 from django.conf import settings
 from django.db import transaction, DatabaseError
@@ -70,11 +71,14 @@ class SnoopTaskBroken(Exception):
 
 class MissingDependency(Exception):
     """Thrown by Task when it depends on another Task that is not finished.
+
+    More dependencies can be added at the same time with `others`, a list of `(name, task)` tuples.
     """
 
-    def __init__(self, name, task):
+    def __init__(self, name, task, others=()):
         self.name = name
         self.task = task
+        self.others = list(others)
 
 
 class ExtraDependency(Exception):
@@ -151,6 +155,7 @@ def import_snoop_tasks():
     """
     from . import filesystem  # noqa
     from .analyzers import archives  # noqa
+    from .analyzers import pst  # noqa
     from .analyzers import text  # noqa
 
 
@@ -319,6 +324,14 @@ def run_task(task, log_handler, raise_exceptions=False):
                         prev=dep.task,
                         name=dep.name,
                     )
+                    if dep.others:
+                        models.TaskDependency.objects.bulk_create(
+                            [
+                                models.TaskDependency(prev=prev, next=task, name=name)
+                                for name, prev in dep.others
+                            ],
+                            ignore_conflicts=True,
+                        )
                     queue_task(task)
 
             except ExtraDependency as dep:
@@ -632,25 +645,36 @@ def returns_json_blob(func):
     Used in various Task functions to return results in JSON format, while also respecting the fact that
     Task results are always Blobs.
 
-
-    Warning:
-        This function dumps the whole JSON at once, from memory, so this may have problems with very large
-        JSON result sizes (>1GB) or dynamically generated results (from a generator).
+    If the function returns a generator (or any other iterator), its items are encoded one by one and
+    written out as a JSON list, so the whole result is never held in memory.
     """
 
     @wraps(func)
     def wrapper(*args, **kwargs):
         rv = func(*args, **kwargs)
 
-        data = json.dumps(rv, indent=2).encode('utf8')
         with models.Blob.create() as output:
-            output.write(data)
+            if isinstance(rv, Iterator):
+                write_json_list(rv, output)
+            else:
+                output.write(json.dumps(rv, indent=2).encode('utf8'))
 
         return output.blob
 
     return wrapper
 
 
+def write_json_list(items, output):
+    """Writes the items as a JSON list, encoding them one at a time."""
+
+    output.write(b'[')
+    for i, item in enumerate(items):
+        if i:
+            output.write(b',')
+        output.write(b'\n' + json.dumps(item, indent=2).encode('utf8'))
+    output.write(b'\n]')
+
+
 def dispatch_walk_tasks():
     """Trigger processing of a collection, starting with its root directory.
     """
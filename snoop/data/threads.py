@@ -0,0 +1,188 @@
+"""Email conversation threads, built incrementally as emails are digested.
+
+Every email seen by [snoop.data.digests.gather][] is added to the
+[ThreadMessage][snoop.data.models.ThreadMessage] table under its normalized Message-ID, together with
+rows for the Message-IDs it refers to through `In-Reply-To`, `References` and Outlook's `Thread-Index`.
+All these rows get the same `thread_id`; when a message links two threads that were separate until then,
+the newer one is merged into the older one, and its documents are re-indexed.
+
+A whole conversation can then be fetched with a single query on the indexed `thread_id` column; see
+[snoop.data.threads.get_thread][].
+"""
+
+import base64
+import binascii
+import logging
+import re
+
+from django.db import transaction
+
+from . import collections
+from . import models
+from .tasks import retry_tasks
+from .utils import zulu
+
+log = logging.getLogger(__name__)
+
+MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+
+THREAD_INDEX_PREFIX_SIZE = 22
+"""Outlook's `Thread-Index` header starts with 22 bytes that are the same for all messages in a thread."""
+
+
+def normalize_message_id(value):
+    """Strips the angle brackets and whitespace from a Message-ID and lowercases it."""
+
+    return value.strip().strip('<>').strip().lower()[:998]
+
+
+def message_ids(value):
+    """Returns all the normalized Message-IDs found in a header value, in order."""
+
+    if not value:
+        return []
+    found = MESSAGE_ID.findall(value)
+    if not found and value.split():
+        found = [value.split()[0]]
+    return [normalize_message_id(x) for x in found if normalize_message_id(x)]
+
+
+def thread_index_key(value):
+    """Returns a placeholder Message-ID shared by all messages with the same Outlook thread."""
+
+    try:
+        data = base64.b64decode(value.strip(), validate=False)
+    except (binascii.Error, ValueError):
+        return None
+    if len(data) < THREAD_INDEX_PREFIX_SIZE:
+        return None
+    return 'thread-index:' + base64.b64encode(data[:THREAD_INDEX_PREFIX_SIZE]).decode('ascii')
+
+
+def related_ids(headers):
+    """Returns the normalized ids of all the messages that the email with these headers refers to."""
+
+    ids = []
+    for header in ['References', 'In-Reply-To']:
+        for value in headers.get(header, []):
+            ids.extend(message_ids(value))
+    for value in headers.get('Thread-Index', []):
+        key = thread_index_key(value)
+        if key:
+            ids.append(key)
+    return list(dict.fromkeys(ids))
+
+
+def own_message_id(blob, headers):
+    """Returns the normalized Message-ID of an email; emails without one get an id made from the Blob."""
+
+    for value in headers.get('Message-Id', []):
+        ids = message_ids(value)
+        if ids:
+            return ids[0]
+    return f'{blob.pk}@snoop'
+
+
+def add_message(blob, headers, subject='', sender='', date=None):
+    """Adds an email to its thread, creating or merging threads as needed.
+
+    The rows without a Blob, one for each Message-ID, are inserted and locked in sorted order, so concurrent
+    `gather` Tasks working on the same thread wait for each other instead of deadlocking. The email gets its
+    own row, so copies of the same message found in different places all stay in the thread.
+
+    Args:
+        blob: the email
+        headers: the parsed headers, as returned by [snoop.data.analyzers.email.parse][]
+
+    Returns:
+        int: the thread id
+    """
+
+    own = own_message_id(blob, headers)
+    ids = sorted({own} | set(related_ids(headers)))
+
+    with transaction.atomic(using=collections.current().db_alias):
+        models.ThreadMessage.objects.bulk_create(
+            [models.ThreadMessage(message_id=x) for x in ids],
+            ignore_conflicts=True,
+        )
+        rows = list(
+            models.ThreadMessage.objects
+            .select_for_update()
+            .filter(message_id__in=ids, blob__isnull=True)
+            .order_by('message_id')
+        )
+        by_id = {row.message_id: row for row in rows}
+        thread_ids = {row.thread_id for row in rows if row.thread_id}
+        thread_id = min(thread_ids) if thread_ids else by_id[own].pk
+
+        merged = thread_ids - {thread_id}
+        if merged:
+            merge_threads(merged, thread_id)
+
+        models.ThreadMessage.objects.filter(pk__in=[row.pk for row in rows]).update(thread_id=thread_id)
+        models.ThreadMessage.objects.update_or_create(
+            message_id=own,
+            blob=blob,
+            defaults={
+                'thread_id': thread_id,
+                'subject': subject,
+                'sender': sender,
+                'date': date,
+            },
+        )
+
+    return thread_id
+
+
+def merge_threads(old_thread_ids, thread_id):
+    """Moves all messages from the old threads into the given one, and re-indexes them."""
+
+    log.info('merging threads %s into %s', sorted(old_thread_ids), thread_id)
+    old_messages = models.ThreadMessage.objects.filter(thread_id__in=old_thread_ids)
+    blob_pks = list(old_messages.filter(blob__isnull=False).values_list('blob', flat=True))
+    old_messages.update(thread_id=thread_id)
+    retry_tasks(
+        models.Task.objects
+        .filter(func='digests.index', blob_arg__in=blob_pks)
+        .exclude(status=models.Task.STATUS_PENDING)
+    )
+
+
+def get_thread_id(blob):
+    """Returns the thread id of an email, or `None` if it wasn't added to a thread."""
+
+    return (
+        models.ThreadMessage.objects
+        .filter(blob=blob)
+        .values_list('thread_id', flat=True)
+        .first()
+    )
+
+
+def get_thread(thread_id):
+    """Returns the messages of a thread, sorted by date, and the ids of the referenced messages we don't
+    have.
+    """
+
+    messages = []
+    message_ids = []
+    found = set()
+    for row in models.ThreadMessage.objects.filter(thread_id=thread_id).order_by('date', 'pk'):
+        if row.blob_id is None:
+            message_ids.append(row.message_id)
+            continue
+        found.add(row.message_id)
+        messages.append({
+            'id': row.blob_id,
+            'message-id': row.message_id,
+            'subject': row.subject,
+            'from': row.sender,
+            'date': zulu(row.date),
+        })
+    missing = [x for x in message_ids if x not in found and not x.startswith('thread-index:')]
+    return {
+        'thread': thread_id,
+        'messages': messages,
+        'missing': missing,
+    }
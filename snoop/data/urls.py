@@ -19,6 +19,7 @@ urlpatterns = [
 
     path('<collection>/<hash>/json', views.document),
     path('<collection>/<hash>/locations', views.document_locations),
+    path('<collection>/<hash>/thread', views.document_thread),
     path('<collection>/<hash>/ocr/<ocrname>', views.document_ocr),
     path('<collection>/<hash>/raw/<filename>', views.document_download),
 
@@ -10,6 +10,7 @@ from . import digests
 from . import ocr
 from . import collections
 from . import serializers
+from . import threads
 from .analyzers import html
 from django.db.models import Q
 
@@ -242,6 +243,19 @@ def document_locations(request, hash):
     return JsonResponse({'locations': locations, 'page': page, 'has_next_page': has_next})
 
 
+@collection_view
+def document_thread(request, hash):
+    """JSON view with all the emails in the conversation thread of a Digest.
+
+    The thread is read from the `snoop.data.models.ThreadMessage` table, built by `snoop.data.threads`.
+    """
+
+    thread_id = threads.get_thread_id(hash)
+    if thread_id is None:
+        raise Http404("Document is not part of an email thread")
+    return JsonResponse(threads.get_thread(thread_id))
+
+
 class TagViewSet(viewsets.ModelViewSet):
     """Django Rest Framework (DRF) View set for the Tags APIs.
 
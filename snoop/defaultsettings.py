@@ -190,7 +190,31 @@ A new directory will be created under this path for every collection processed.
 """
 
 SNOOP_TIKA_URL = os.environ.get('SNOOP_TIKA_URL', 'http://localhost:9998')
-"""URL pointing to Apache Tika server."""
+"""URL pointing to Apache Tika server.
+
+Can be a comma-separated list of URLs, to balance the work between many Tika servers.
+"""
+
+TIKA_MAX_FAILURES = 3
+"""Number of failed calls or health checks in a row after which a Tika server is not used for a while."""
+
+TIKA_EJECT_SECONDS = 60
+"""Seconds to wait before checking a failed Tika server again."""
+
+TIKA_HEALTH_CHECK_SECONDS = 10
+"""Interval between the health checks made on the Tika servers by each worker process."""
+
+TIKA_POOL_SIZE = int(os.environ.get('SNOOP_TIKA_POOL_SIZE', '4'))
+"""Number of keep-alive connections to Tika kept open by each worker process."""
+
+TIKA_CONNECT_TIMEOUT = float(os.environ.get('SNOOP_TIKA_CONNECT_TIMEOUT', '10'))
+"""Seconds to wait for a connection to the Tika server."""
+
+TIKA_READ_TIMEOUT = float(os.environ.get('SNOOP_TIKA_READ_TIMEOUT', '1800'))
+"""Seconds to wait for Tika to send back data, after the document was sent.
+
+Large spreadsheets and PDFs can take many minutes to parse.
+"""
 
 SNOOP_FEED_PAGE_SIZE = 100
 """Pagination size for the /feed URLs.
@@ -264,6 +288,101 @@ SYNC_RETRY_LIMIT = 60 * _scale_coef
 will be retried by sync every minute.
 """
 
+BLOB_FILTER_ENABLED = True
+"""Keep an in-memory Bloom filter of existing Blobs in every worker, to skip database lookups for new Blobs.
+
+See [snoop.data.bloom][] for details.
+"""
+
+BLOB_FILTER_CAPACITY = 10 ** 6
+"""Minimum number of keys the Blob filter is sized for.
+
+The filter is sized for twice the number of Blobs found when seeding it, if that's larger.
+"""
+
+BLOB_FILTER_ERROR_RATE = 0.01
+"""False positive rate of the Blob filter, when filled up to capacity.
+
+False positives only cost an extra database lookup.
+"""
+
+WALK_CHUNK_SIZE = 10 ** 4
+"""Maximum number of directory entries processed by a single [snoop.data.filesystem.walk][] Task.
+
+Larger directories are processed in chunks, each in its own
+[snoop.data.filesystem.walk_chunk][] Task and database transaction, so the rows written and the tasks
+queued when the transaction commits stay bounded.
+"""
+
+WALK_HASH_THREADS = int(os.environ.get('SNOOP_WALK_HASH_THREADS', '4'))
+"""Number of threads used by a single [snoop.data.filesystem.walk][] Task to hash and copy the files in one
+directory.
+
+This work is I/O-bound (and `hashlib` releases the GIL), so it helps most on network storage. Database writes
+are still made by the Task's own thread. Set to 1 to process files one at a time.
+"""
+
+EXTRACTION_LIMITS = {
+    'max_bytes': 100 * 2 ** 30,
+    'max_members': 10 ** 6,
+    'max_depth': 10,
+    'max_ratio': 1000,
+    'max_seconds': 12 * 3600,
+}
+"""Limits enforced while unpacking a single archive, email archive or PDF.
+
+- `max_bytes`: total size of the files extracted
+- `max_members`: number of files extracted
+- `max_depth`: how many archives can be nested inside each other
+- `max_ratio`: total size of the files extracted, divided by the size of the archive (archives under 1 MB
+  are counted as 1 MB)
+- `max_seconds`: wall-clock time spent extracting
+
+Going over any of them marks the Task as broken. Can be overriden for each collection with the
+`extraction_limits` option; see [snoop.data.analyzers.archives.ExtractionBudget][].
+"""
+
+PGP_DECRYPT_CACHE_SIZE = 64 * 2 ** 20
+"""Size in bytes of the cache of decrypted PGP payloads kept by each worker process.
+
+The cache is shared by all the collections the worker handles.
+"""
+
+EMAIL_HTML_WITH_TIKA = False
+"""Send the HTML parts of emails to Tika to extract their text.
+
+By default, the text is extracted in-process by [snoop.data.analyzers.html.html_to_text][], which avoids
+queueing a Tika Task and parsing the email a second time.
+"""
+
+EXTRACTION_MAX_THREADS = int(os.environ.get('SNOOP_EXTRACTION_MAX_THREADS', '4'))
+"""Maximum number of threads used by `7z` to decompress a single archive.
+
+Fewer threads are used for small archives and when the node is already busy; see
+[snoop.data.analyzers.archives.extraction_threads][].
+"""
+
+EXTRACTION_BYTES_PER_THREAD = 64 * 2 ** 20
+"""Archive size that justifies one more decompression thread."""
+
+PST_NATIVE_READER = True
+"""Read PST files in-process with `pypff` (from `libpff-python`) instead of running `readpst`.
+
+Has no effect if `pypff` is not installed.
+"""
+
+PST_MESSAGES_PER_TASK = 5000
+"""Number of messages extracted from a PST folder by a single Task, when using `pypff`."""
+
+PDF_IMAGES_PAGES_PER_RUN = 50
+"""Number of pages handled by a single `pdfimages` process when extracting images from PDFs."""
+
+PDF_IMAGES_THREADS = 4
+"""Number of `pdfimages` processes run at the same time for a single PDF."""
+
+PDF_IMAGES_MIN_SIZE = 32
+"""Images extracted from PDFs that are smaller than this (in pixels) on either side are dropped."""
+
 PDF2PDFOCR_MAX_STRLEN = 4 * (2 ** 20)
 """ Only run pdf2pdfocr if pdf text length less than this value.
 
@@ -168,3 +168,200 @@ def test_unarchive_mbox(taskmanager, testdata_current):
              'type': 'file'}],
         'name': '07',
         'type': 'directory'}
+
+
+def sorted_listing(listing):
+    return sorted(
+        (dict(x, children=sorted_listing(x['children'])) if x['type'] == 'directory' else x
+         for x in listing),
+        key=lambda x: x['name'],
+    )
+
+
+def test_streaming_zip_matches_7z(taskmanager, testdata_current):
+    zip_blob = models.Blob.create_from_file(JERRY_ZIP)
+    streamed = archives.stream_archive(zip_blob, archives.ExtractionBudget(zip_blob.size))
+    extracted = archives.extract_to_temp_dir(zip_blob, archives.ExtractionBudget(zip_blob.size))
+    assert streamed is not None
+    assert sorted_listing(streamed) == sorted_listing(extracted)
+
+
+def test_streaming_falls_back_to_7z(taskmanager, testdata_current, monkeypatch):
+    def broken_zip(path, budget):
+        raise NotImplementedError('compression type 9 (deflate64)')
+
+    monkeypatch.setattr(archives, 'stream_zip', broken_zip)
+    zip_blob = models.Blob.create_from_file(JERRY_ZIP)
+    listing_blob = archives.unarchive(zip_blob)
+    with listing_blob.open() as f:
+        listing = json.load(f)
+    assert listing[0]['name'] == 'jerry'
+
+
+def test_extraction_budget_member_limit(taskmanager, testdata_current):
+    from snoop.data.tasks import SnoopTaskBroken
+
+    budget = archives.ExtractionBudget(JERRY_ZIP.stat().st_size,
+                                       limits=dict(settings.EXTRACTION_LIMITS, max_members=2))
+    with pytest.raises(SnoopTaskBroken) as e:
+        archives.stream_zip(JERRY_ZIP, budget)
+    assert e.value.reason == 'archive_member_limit'
+
+
+def test_extraction_budget_kills_process(tmp_path):
+    from snoop.data.tasks import SnoopTaskBroken
+
+    budget = archives.ExtractionBudget(1, limits=dict(settings.EXTRACTION_LIMITS, max_bytes=2 ** 20))
+    with pytest.raises(SnoopTaskBroken) as e:
+        archives.run_limited(
+            ['sh', '-c', 'head -c 3000000 /dev/zero > out; sleep 30'],
+            tmp_path, budget, cwd=tmp_path, poll_interval=0.1,
+        )
+    assert e.value.reason == 'archive_size_limit'
+
+
+def test_unpack_pdf_page_ranges_match_single_run(taskmanager, testdata_current, monkeypatch):
+    pdf = Path(settings.SNOOP_TESTDATA) / "data/disk-files/pdf-for-ocr/mof1_1992_233.pdf"
+    pdf_blob = models.Blob.create_from_file(pdf)
+
+    def listing_with(pages_per_run):
+        monkeypatch.setattr(settings, 'PDF_IMAGES_PAGES_PER_RUN', pages_per_run)
+        budget = archives.ExtractionBudget(pdf_blob.size)
+        return sorted_listing(archives.extract_to_temp_dir(pdf_blob, budget))
+
+    single_run = listing_with(10 ** 6)
+    assert single_run
+    assert listing_with(1) == single_run
+    assert len(set(x['blob_pk'] for x in single_run)) == len(single_run)
+
+    # without a page count from pdfinfo, pdfimages runs once on the whole document
+    monkeypatch.setattr(archives, 'pdf_page_count', lambda pdf_path: 0)
+    assert listing_with(1) == single_run
+
+
+def test_gzip_member_name(tmp_path):
+    import gzip
+
+    with open(tmp_path / 'named.gz', 'wb') as f:
+        with gzip.GzipFile('report.txt', 'wb', fileobj=f) as g:
+            g.write(b'hello')
+    with open(tmp_path / 'unnamed.gz', 'wb') as f:
+        f.write(gzip.compress(b'hello'))
+
+    assert archives.gzip_member_name(tmp_path / 'named.gz') == 'report.txt'
+    assert archives.gzip_member_name(tmp_path / 'unnamed.gz') is None
+
+
+def test_pst_message_attachments_are_streamed(monkeypatch):
+    import email
+    from snoop.data.analyzers import pst
+
+    monkeypatch.setattr(pst, 'ATTACHMENT_CHUNK_SIZE', 100)
+
+    class FakeAttachment:
+        record_sets = []
+
+        def __init__(self, data):
+            self.data = data
+            self.reads = []
+
+        def get_size(self):
+            return len(self.data)
+
+        def read_buffer(self, size):
+            start = sum(self.reads)
+            self.reads.append(min(size, len(self.data) - start))
+            return self.data[start:start + size]
+
+    class FakeMessage:
+        transport_headers = 'Subject: hello\r\nContent-Type: text/plain\r\n'
+        subject = 'hello'
+        plain_text_body = b'see attached'
+        html_body = None
+
+        def __init__(self, attachments):
+            self.attachments = [FakeAttachment(data) for data in attachments]
+            self.number_of_attachments = len(attachments)
+
+        def get_attachment(self, n):
+            return self.attachments[n]
+
+    attachments = [bytes(range(256)) * 3, b'']
+    message = FakeMessage(attachments)
+    with models.Blob.create() as output:
+        pst.write_message(message, output)
+
+    with output.blob.open() as f:
+        eml = email.message_from_binary_file(f)
+    assert eml['Subject'] == 'hello'
+    parts = [part for part in eml.walk() if part.get_content_disposition() == 'attachment']
+    assert [part.get_payload(decode=True) for part in parts] == attachments
+    assert max(message.attachments[0].reads) == 100
+
+
+def test_pst_sibling_folders_with_the_same_name(monkeypatch):
+    from contextlib import contextmanager
+    from snoop.data.analyzers import pst
+
+    class FakeFolder:
+        def __init__(self, name, sub_folders=()):
+            self.name = name
+            self.sub_folders = list(sub_folders)
+            self.number_of_sub_folders = len(self.sub_folders)
+            self.number_of_sub_messages = 1
+
+        def get_sub_folder(self, i):
+            return self.sub_folders[i]
+
+    class FakePst:
+        def get_root_folder(self):
+            return FakeFolder('', [FakeFolder('Inbox'), FakeFolder('Inbox'), FakeFolder('In/box'),
+                                   FakeFolder('In_box')])
+
+    monkeypatch.setattr(pst, 'open_pst', contextmanager(lambda blob: iter([FakePst()])))
+    folders_blob = pst.list_folders(models.Blob.create_from_bytes(b'not really a pst'))
+    with folders_blob.open() as f:
+        paths = [folder['path'] for folder in json.load(f)]
+
+    assert paths == [[], ['Inbox'], ['Inbox_1'], ['In_box'], ['In_box_3']]
+
+
+def test_unarchive_checks_nesting_depth_before_extracting(taskmanager, testdata_current, monkeypatch):
+    from conftest import mkfile
+    from snoop.data import collections
+    from snoop.data.tasks import SnoopTaskBroken
+
+    zip_blob = models.Blob.create_from_file(JERRY_ZIP)
+    mkfile(models.Directory.objects.create(), 'jerry.zip', zip_blob)
+    monkeypatch.setitem(collections.current().extraction_limits, 'max_depth', 0)
+    monkeypatch.setattr(archives, 'stream_archive', lambda *args: pytest.fail('archive was extracted'))
+
+    with pytest.raises(SnoopTaskBroken) as e:
+        archives.unarchive(zip_blob)
+    assert e.value.reason == 'archive_nesting_limit'
+
+
+def test_pst_budget_counts_all_ranges():
+    from snoop.data.analyzers import pst
+    from snoop.data.tasks import SnoopTaskBroken
+
+    def json_blob(data):
+        return models.Blob.create_from_bytes(json.dumps(data).encode('utf8'))
+
+    message = models.Blob.create_from_bytes(b'Subject: hello\n\nhello\n')
+    depends_on = {
+        'pst_folders': json_blob([
+            {'index': '', 'path': [], 'messages': 0},
+            {'index': '0', 'path': ['Inbox'], 'messages': 1},
+            {'index': '1', 'path': ['Sent'], 'messages': 1},
+        ]),
+    }
+    for index in ['0', '1']:
+        depends_on[f'pst_messages_{index}_0'] = json_blob([
+            {'type': 'file', 'name': '1.eml', 'blob_pk': message.pk, 'size': message.size},
+        ])
+
+    budget = archives.ExtractionBudget(1, limits=dict(settings.EXTRACTION_LIMITS, max_members=1))
+    with pytest.raises(SnoopTaskBroken) as e:
+        pst.unpack(models.Blob.create_from_bytes(b'not really a pst'), depends_on, budget)
+    assert e.value.reason == 'archive_member_limit'
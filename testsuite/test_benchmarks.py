@@ -0,0 +1,152 @@
+"""Timing comparisons for the parallel and streaming code paths.
+
+The synthetic datasets are kept small so these run with the rest of the suite; set `SNOOP_BENCHMARK_SCALE`
+to a larger number to get meaningful timings (1000 gives a 1M-message MBOX). Results are printed, use
+`pytest -s` to see them.
+"""
+
+import io
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from snoop.data import filesystem
+from snoop.data import models
+from snoop.data.analyzers import archives
+from snoop.data.analyzers import email
+
+pytestmark = [pytest.mark.django_db]
+
+SCALE = int(os.environ.get('SNOOP_BENCHMARK_SCALE', '1'))
+
+
+def report(name, **timings):
+    print()
+    for key, value in timings.items():
+        print(f'benchmark {name} {key}: {value:.3f}s')
+
+
+def make_tree(root, files=20, size=2 ** 16):
+    paths = []
+    for i in range(files * SCALE):
+        path = Path(root) / f'file-{i:05d}.bin'
+        path.write_bytes(os.urandom(size))
+        paths.append(path)
+    # add a duplicate, to check it's only stored once
+    dup = Path(root) / 'duplicate.bin'
+    dup.write_bytes(paths[0].read_bytes())
+    paths.append(dup)
+    return paths
+
+
+def test_ingest_files_threads():
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_tree(root)
+
+        t0 = time.perf_counter()
+        sequential = filesystem.ingest_files(paths, threads=1)
+        t1 = time.perf_counter()
+        models.Blob.objects.all().delete()
+        parallel = filesystem.ingest_files(paths, threads=8)
+        t2 = time.perf_counter()
+
+    assert [(p, b.pk) for p, _, b in sequential] == [(p, b.pk) for p, _, b in parallel]
+    assert sequential[0][2].pk == sequential[-1][2].pk
+    assert models.Blob.objects.count() == len(paths) - 1
+    report('ingest_files', sequential=t1 - t0, parallel=t2 - t1)
+
+
+def old_mbox_slice(stream):
+    """The previous MBOX splitter, which searches a growing window; kept here for comparison."""
+    last = b''
+    while True:
+        buffer = stream.read(1024 * 64)
+        if not buffer:
+            break
+        window = last + buffer
+        while True:
+            m = re.search(br'\n\r?\n(From )', window)
+            if not m:
+                break
+            offset = m.start(1)
+            yield window[:offset]
+            window = window[offset:]
+        last = window
+    yield last
+
+
+def make_mbox(messages):
+    parts = []
+    for i in range(messages):
+        body = b'line of text\n' * (i % 50) + b'>From the middle of a line\n'
+        parts.append(
+            b'From sender@example.com Mon Jan  1 00:00:00 2021\n'
+            b'Subject: message %d\n\n%s\n' % (i, body)
+        )
+    return b''.join(parts)
+
+
+def test_mbox_offsets():
+    data = make_mbox(1000 * SCALE)
+
+    t0 = time.perf_counter()
+    old = list(old_mbox_slice(io.BytesIO(data)))
+    t1 = time.perf_counter()
+    new = [data[offset:offset + length] for offset, length in archives.mbox_offsets(memoryview(data))]
+    t2 = time.perf_counter()
+
+    assert new == old
+    assert len(new) == 1000 * SCALE
+    report('mbox_offsets', old=t1 - t0, new=t2 - t1)
+
+
+CHARSET_SAMPLES = [
+    ('utf-8', 'Ceci est un message en français, avec des accents: à bientôt, déjà, où, garçon. '),
+    ('iso-8859-1', 'Hola, ¿cómo estás? El niño comió una piña en el año nuevo, señor. '),
+    ('cp1251', 'Привет, это тестовое сообщение на русском языке для проверки кодировки. '),
+    ('iso-8859-2', 'Zażółć gęślą jaźń, to jest wiadomość po polsku z ogonkami. '),
+    ('cp1250', 'Acesta este un mesaj în limba română, cu diacritice: şi, ţară, până. '),
+    ('shift_jis', 'これは日本語のテストメッセージです。文字コードを確認します。'),
+    ('gb2312', '这是一封用于测试字符编码检测的中文电子邮件。'),
+    ('utf-8', 'Αυτό είναι ένα μήνυμα στα ελληνικά, γραμμένο σε UTF-8. '),
+    ('ascii', 'A plain ASCII message, like most of the mail out there. '),
+]
+
+
+def make_text_parts(count):
+    parts = []
+    for i in range(count):
+        charset, text = CHARSET_SAMPLES[i % len(CHARSET_SAMPLES)]
+        text = text * (1 + i % 200)
+        parts.append((charset, text, text.encode(charset)))
+    return parts
+
+
+def test_charset_detection():
+    import chardet
+
+    parts = make_text_parts(100 * SCALE)
+
+    t0 = time.perf_counter()
+    old = []
+    for _, _, data in parts:
+        charset = chardet.detect(data).get('encoding') or 'latin1'
+        old.append(data.decode(charset, errors='replace'))
+    t1 = time.perf_counter()
+    new = [email.decode_text(data) for _, _, data in parts]
+    t2 = time.perf_counter()
+
+    for (charset, text, _), decoded in zip(parts, new):
+        if charset in ('utf-8', 'ascii'):
+            assert decoded == text
+    expected = [text for _, text, _ in parts]
+    old_correct = sum(a == b for a, b in zip(old, expected))
+    new_correct = sum(a == b for a, b in zip(new, expected))
+    agreement = sum(a == b for a, b in zip(old, new)) / len(parts)
+    report('charset_detection', old=t1 - t0, new=t2 - t1)
+    print(f'benchmark charset_detection agreement: {agreement:.1%}, correct: old {old_correct}, '
+          f'new {new_correct} of {len(parts)}')
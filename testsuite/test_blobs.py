@@ -1,6 +1,6 @@
 import pytest
 from django.conf import settings
-from snoop.data import models
+from snoop.data import collections, models
 
 pytestmark = [pytest.mark.django_db]
 
@@ -122,3 +122,53 @@ def test_blob_mime_types(testdata_relative_path, expected_mime_type):
     file_path = settings.SNOOP_TESTDATA + testdata_relative_path
     blob = models.Blob.create_from_file(file_path).mime_type
     assert blob == expected_mime_type
+
+
+def test_bloom_filter_has_no_false_negatives():
+    from hashlib import sha3_256
+    from snoop.data.bloom import BloomFilter
+
+    keys = [sha3_256(str(i).encode()).hexdigest() for i in range(2000)]
+    bloom = BloomFilter(1000, 0.01)
+    for key in keys[:1000]:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys[:1000])
+    false_positives = sum(key in bloom for key in keys[1000:])
+    assert false_positives < 50
+
+
+def test_existing_pks_and_duplicate_blobs():
+    blob = models.Blob.create_from_bytes(b'some bytes that exist')
+    missing = 'f' * 64
+    assert models.Blob.existing_pks([blob.pk, missing]) == {blob.pk}
+
+    with models.Blob.create() as writer:
+        writer.write(b'some bytes that exist')
+    assert writer.blob == blob
+    assert blob.path().exists()
+
+
+def test_failed_blob_create_removes_temp_file():
+    tmp_dir = collections.current().tmp_dir
+    tmp_dir.mkdir(exist_ok=True, parents=True)
+    before = set(tmp_dir.iterdir())
+
+    with pytest.raises(RuntimeError):
+        with models.Blob.create() as writer:
+            writer.write(b'half of a blob')
+            raise RuntimeError('failed while writing')
+
+    assert set(tmp_dir.iterdir()) == before
+
+
+def test_blob_mmap():
+    blob = models.Blob.create_from_bytes(b'mapped blob content')
+    with blob.mmap() as data:
+        assert data.readonly
+        assert bytes(data[7:11]) == b'blob'
+        assert str(data, 'ascii') == 'mapped blob content'
+
+    empty = models.Blob.create_from_bytes(b'')
+    with empty.mmap() as data:
+        assert len(data) == 0
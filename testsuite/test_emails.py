@@ -1,13 +1,16 @@
 import json
+from email import message_from_bytes
 from pathlib import Path
 import pytest
 from django.utils import timezone
 from django.conf import settings
 from snoop.data.analyzers import email
 from snoop.data.analyzers import emlx
+from snoop.data.analyzers import html
 from snoop.data import models
 from snoop.data import filesystem
 from snoop.data import digests
+from snoop.data import threads
 from conftest import mkdir, mkfile
 
 pytestmark = [pytest.mark.django_db]
@@ -45,6 +48,77 @@ def test_email_header_parsing():
     assert content['headers']['Subject'] == ['Attachments have long file names.']
 
 
+def test_streaming_parser_decodes_attachments_into_blobs():
+    for path in [CAMPUS, LONG_FILENAMES, OCTET_STREAM_CONTENT_TYPE]:
+        with email.parse(models.Blob.create_from_file(path)).open() as f:
+            data = json.load(f)
+
+        def attachments(part):
+            if 'attachment' in part:
+                yield part['attachment']['blob_pk']
+            for child in part.get('parts', []):
+                yield from attachments(child)
+
+        expected = [
+            part.get_payload(decode=True)
+            for part in message_from_bytes(path.read_bytes()).walk()
+            if part.get_content_disposition() and part.get_filename()
+        ]
+        found = []
+        for blob_pk in attachments(data):
+            with models.Blob.objects.get(pk=blob_pk).open() as f:
+                found.append(f.read())
+        assert found == expected
+
+
+@pytest.mark.parametrize('body', [
+    b'QUJD\nRA==\n',
+    b'QQ==\nQkI=\n',
+    b'QQ=\n=\nQkI=\n',
+    b'Q=Q==\n',
+    b'QUJ\nDRA\n',
+    b'QU=JD\n',
+])
+def test_payload_decoder_matches_email_package(body):
+    decoder = email.PayloadDecoder('base64')
+    decoded = b''.join(decoder.decode(line) for line in body.splitlines(keepends=True)) + decoder.finish()
+    message = message_from_bytes(b'Content-Transfer-Encoding: base64\n\n' + body)
+    assert decoded == message.get_payload(decode=True)
+
+
+def test_streaming_parser_splits_long_quoted_printable_lines(monkeypatch):
+    monkeypatch.setattr(email, 'MAX_LINE_LENGTH', 16)
+    body = b'caf=C3=A9 ' * 20 + b'\n'
+    message = (
+        b'Content-Type: text/plain; charset=utf-8\n'
+        b'Content-Transfer-Encoding: quoted-printable\n\n'
+    ) + body
+    with email.parse(models.Blob.create_from_bytes(message)).open() as f:
+        data = json.load(f)
+    assert data['text'] == message_from_bytes(message).get_payload(decode=True).decode('utf8')
+
+
+def test_streaming_parser_multipart_without_closing_boundary():
+    message = (
+        b'Content-Type: multipart/mixed; boundary="b"\n\n'
+        b'--b\nContent-Type: text/plain\n\nfirst\n\n'
+        b'--b\nContent-Type: text/plain\n\nlast\nline\n'
+    )
+    with email.parse(models.Blob.create_from_bytes(message)).open() as f:
+        data = json.load(f)
+    assert [part['text'] for part in data['parts']] == [
+        part.get_payload() for part in message_from_bytes(message).get_payload()
+    ]
+
+
+def test_html_to_text():
+    text = html.html_to_text(
+        '<html><head><style>p { color: red }</style><script>alert(1)</script></head>'
+        '<body><p>Hello&nbsp;&amp;   world</p><div>one<br>two</div></body></html>'
+    )
+    assert text == 'Hello & world\n\none\ntwo'
+
+
 def add_email_to_collection(path):
     blob = models.Blob.create_from_file(path)
     assert blob.mime_type == 'message/rfc822'
@@ -249,3 +323,45 @@ def test_emlx_reconstruction_with_missing_file(taskmanager):
 
     assert size['Legea-299-2015-informatiile-publice.odt'] == 28195
     assert size['Legea-299-2015-informatiile-publice.pdf'] == 0
+
+
+def test_threads_are_merged_by_references():
+    first = models.Blob.create_from_bytes(b'first')
+    second = models.Blob.create_from_bytes(b'second')
+    reply = models.Blob.create_from_bytes(b'reply')
+
+    first_thread = threads.add_message(first, {'Message-Id': ['<A@example.com>']}, subject='first')
+    second_thread = threads.add_message(second, {
+        'Message-Id': ['<b@example.com>'],
+        'In-Reply-To': ['<parent@example.com>'],
+    })
+    assert first_thread != second_thread
+
+    reply_thread = threads.add_message(reply, {
+        'Message-Id': ['<c@example.com>'],
+        'References': ['<a@example.com> <b@example.com>'],
+    })
+    assert reply_thread == min(first_thread, second_thread)
+    assert threads.get_thread_id(first) == threads.get_thread_id(second) == reply_thread
+
+    thread = threads.get_thread(reply_thread)
+    assert {m['id'] for m in thread['messages']} == {first.pk, second.pk, reply.pk}
+    assert thread['missing'] == ['parent@example.com']
+
+
+def test_thread_keeps_every_copy_of_a_message():
+    copy = models.Blob.create_from_bytes(b'copy')
+    other_copy = models.Blob.create_from_bytes(b'other copy')
+
+    thread_id = threads.add_message(copy, {'Message-Id': ['<same@example.com>']})
+    assert threads.add_message(other_copy, {'Message-Id': ['<same@example.com>']}) == thread_id
+    assert threads.get_thread_id(copy) == threads.get_thread_id(other_copy) == thread_id
+
+    thread = threads.get_thread(thread_id)
+    assert {m['id'] for m in thread['messages']} == {copy.pk, other_copy.pk}
+    assert thread['missing'] == []
+
+
+def test_invalid_date_is_ignored():
+    assert email.parse_date('Mon, 32 Jan 2020 10:00:00 +0000') is None
+    assert email.parse_date('Mon, 27 Jan 2020 10:00:00 +0000').day == 27
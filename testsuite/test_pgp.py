@@ -7,6 +7,7 @@ import pytest
 from snoop.data import models
 from snoop.data import tasks
 from snoop.data.analyzers import email
+from snoop.data.analyzers import pgp
 from conftest import CollectionApiClient
 
 PATH_HUSH_MAIL = 'eml-9-pgp/encrypted-hushmail-knockoff.eml'
@@ -61,3 +62,31 @@ def test_broken_if_no_gpg_home(gpg_blob, monkeypatch):
         email.parse(gpg_blob)
 
     assert e.value.reason == 'gpg_not_configured'
+
+
+def test_decrypted_payloads_are_cached(gpg_blob, monkeypatch):
+    email.parse(gpg_blob)
+
+    calls = []
+    run = pgp.subprocess.run
+
+    def counting_run(args, **kwargs):
+        calls.append(args)
+        return run(args, **kwargs)
+
+    monkeypatch.setattr(pgp.subprocess, 'run', counting_run)
+    email.parse(gpg_blob)
+    assert not [args for args in calls if '--decrypt' in args]
+
+
+def test_decrypt_cache_is_bounded_per_process(monkeypatch):
+    monkeypatch.setattr(settings, 'PGP_DECRYPT_CACHE_SIZE', 10)
+    monkeypatch.setattr(pgp, '_caches', {})
+    cache = pgp.decrypt_cache()
+    assert pgp.decrypt_cache() is cache
+
+    cache.add(('collection-a', 'hash'), b'123456')
+    cache.add(('collection-b', 'hash'), b'654321')
+    assert cache.get(('collection-a', 'hash')) is None
+    assert cache.get(('collection-b', 'hash')) == b'654321'
+    assert cache.size == 6
@@ -1,5 +1,6 @@
+import json
 import pytest
-from snoop.data.tasks import snoop_task, require_dependency, SnoopTaskBroken
+from snoop.data.tasks import snoop_task, require_dependency, returns_json_blob, SnoopTaskBroken
 from snoop.data import models
 
 pytestmark = [pytest.mark.django_db]
@@ -106,3 +107,13 @@ def test_broken_dependency(taskmanager):
     two_task.refresh_from_db()
     with two_task.result.open() as f:
         assert f.read() == b'it did fail'
+
+
+def test_returns_json_blob_streams_generators():
+    @returns_json_blob
+    def listing():
+        for i in range(3):
+            yield {'n': i}
+
+    with listing().open() as f:
+        assert json.load(f) == [{'n': 0}, {'n': 1}, {'n': 2}]
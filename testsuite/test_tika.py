@@ -1,6 +1,12 @@
+import io
+import json
 import pytest
+import requests
+from django.conf import settings
 
 from conftest import TESTDATA, CollectionApiClient
+from snoop.data import models
+from snoop.data.analyzers import tika
 
 pytestmark = [pytest.mark.django_db]
 
@@ -20,3 +26,110 @@ def test_tika_digested(fakedata, taskmanager, client):
     assert "Colors and Lines to choose" in digest['text']
     assert digest['date'] == '2016-01-13T11:05:00Z'
     assert digest['date-created'] == '2016-01-13T11:00:00Z'
+
+
+def test_tika_session_is_reused_in_process(monkeypatch):
+    session = tika.tika_session()
+    assert tika.tika_session() is session
+
+    monkeypatch.setattr(tika.os, 'getpid', lambda: -1)
+    assert tika.tika_session() is not session
+
+
+def test_tika_pool_balances_and_ejects(monkeypatch):
+    monkeypatch.setattr(settings, 'TIKA_MAX_FAILURES', 2)
+    pool = tika.TikaPool(['http://tika-a:9998', 'http://tika-b:9998'])
+
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    pool.release(first, ok=False)
+    pool.release(second, ok=False)
+
+    for _ in range(2):
+        pool.release(pool.acquire(), ok=False)
+    with pytest.raises(requests.ConnectionError):
+        pool.acquire()
+
+
+def test_tika_read_timeouts_are_not_blamed_on_servers(monkeypatch):
+    pool = tika.TikaPool(['http://tika-a:9998', 'http://tika-b:9998'])
+    monkeypatch.setattr(tika, 'tika_pool', lambda: pool)
+    calls = []
+
+    class SlowSession:
+        def put(self, url, **kwargs):
+            calls.append(url)
+            raise requests.ReadTimeout('too slow')
+
+    monkeypatch.setattr(tika, 'tika_session', lambda: SlowSession())
+    with pytest.raises(requests.ReadTimeout):
+        tika.call_tika_server('rmeta/text', io.BytesIO(b'data'), 'text/plain')
+    assert len(calls) == 1
+    assert [backend.failures for backend in pool.backends] == [0, 0]
+
+
+def test_tika_health_checks_take_servers_back(monkeypatch):
+    monkeypatch.setattr(settings, 'TIKA_MAX_FAILURES', 1)
+    monkeypatch.setattr(settings, 'TIKA_EJECT_SECONDS', 0)
+    pool = tika.TikaPool(['http://tika-a:9998'])
+    up = {'http://tika-a:9998/tika': False}
+
+    class Response:
+        status_code = 200
+
+    def get(url, timeout):
+        if not up[url]:
+            raise requests.ConnectionError(url)
+        return Response()
+
+    monkeypatch.setattr(tika.requests, 'get', get)
+    pool.check_all()
+    with pytest.raises(requests.ConnectionError):
+        pool.acquire()
+
+    up['http://tika-a:9998/tika'] = True
+    pool.check_all()
+    assert pool.acquire() is pool.backends[0]
+
+
+def test_json_response_is_streamed_into_blob():
+    class FakeResponse:
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        def iter_content(self, chunk_size):
+            return iter(self.chunks)
+
+    with models.Blob.create() as output:
+        tika.write_json_response(FakeResponse([b'[{"X-TIKA', b':content": "hello"}]\n']), output)
+    with output.blob.open() as f:
+        assert json.load(f) == [{'X-TIKA:content': 'hello'}]
+
+    with pytest.raises(RuntimeError):
+        with models.Blob.create() as output:
+            tika.write_json_response(FakeResponse([b'[{"X-TIKA:content": "hel']), output)
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'[{"a":["x"]'],
+    [b'[{"a": "', b']}]'],
+    [b'[{"a": "\\', b'"]}]'],
+    [b'[{"a": 1}]', b'}'],
+    [b'{"a": 1}'],
+])
+def test_truncated_json_response_is_rejected(chunks):
+    class FakeResponse:
+        def iter_content(self, chunk_size):
+            return iter(chunks)
+
+    with pytest.raises(RuntimeError):
+        with models.Blob.create() as output:
+            tika.write_json_response(FakeResponse(), output)
+
+
+def test_json_response_brackets_inside_strings_are_ignored():
+    structure = tika.JsonStructure()
+    for chunk in [b'[{"a": "]}\\', b'"\\\\", "b', b'": ["{"]}', b']\n']:
+        structure.feed(chunk)
+    assert structure.complete
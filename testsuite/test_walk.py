@@ -2,6 +2,7 @@ from pathlib import Path
 import tempfile
 
 import pytest
+from django.conf import settings
 
 from snoop.data import tasks
 from snoop.data import filesystem
@@ -86,3 +87,235 @@ def test_children_of_archives_in_multiple_locations(taskmanager, monkeypatch):
     assert d1.parent == z1
     assert d2.child_directory_set.all()[0].parent == d2
     assert d2.parent == z2
+
+
+def test_materialized_paths(taskmanager, monkeypatch):
+    monkeypatch.setattr(
+        collections.Collection,
+        'DATA_DIR',
+        'data/zip-in-multiple-locations',
+    )
+    models.Directory.objects.create()
+
+    with mask_out_current_collection():
+        tasks.run_dispatcher()
+
+    taskmanager.run(limit=10000)
+
+    for item in list(models.Directory.objects.all()) + list(models.File.objects.all()):
+        names = []
+        node = item
+        while node:
+            names.insert(0, bytes(node.name_bytes))
+            node = node.parent
+        assert bytes(item.path_bytes) == b'/'.join(names)
+        assert models.get_path_bytes(item) == bytes(item.path_bytes)
+
+    zip_dirs = models.Directory.objects.filter(path_bytes=b'/location-1/parent.zip/')
+    assert [str(d) for d in zip_dirs] == ['/location-1/parent.zip//']
+
+
+def test_walk_prunes_unchanged_directories(taskmanager, monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'sub').mkdir()
+        (Path(dir) / 'sub' / 'a.txt').write_text('hello world\n')
+        root = models.Directory.objects.create()
+
+        filesystem.walk(root.pk)
+        root.refresh_from_db()
+        fingerprint = root.fingerprint
+        assert fingerprint and root.mtime
+
+        [sub] = models.Directory.objects.filter(parent_directory=root)
+        filesystem.walk(sub.pk)
+
+        # the listing of the child changed, so the parent isn't pruned
+        calls = []
+        monkeypatch.setattr(filesystem, 'ingest_files', lambda paths: calls.append(paths) or [])
+        filesystem.walk(root.pk)
+        root.refresh_from_db()
+        assert root.fingerprint != fingerprint
+        assert calls == [[]]
+
+        # nothing changed since
+        filesystem.walk(root.pk)
+        filesystem.walk(sub.pk)
+        assert calls == [[]]
+        pruned = models.Statistics.objects.get(key='walk').value
+        assert pruned == {'pruned_directories': 2, 'pruned_entries': 2}
+
+        (Path(dir) / 'sub' / 'b.txt').write_text('second file\n')
+        filesystem.walk(sub.pk)
+        # only the new file is hashed again
+        assert [p.name for p in calls[1]] == ['b.txt']
+
+
+def test_watcher_retries_changed_directories(taskmanager, monkeypatch):
+    from snoop.data.management.commands.watchsync import Watcher
+
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'sub').mkdir()
+        root = models.Directory.objects.create()
+        filesystem.walk(root.pk)
+        [sub] = models.Directory.objects.filter(parent_directory=root)
+
+        watcher = Watcher(collections.current(), debounce=0)
+        watcher.start()
+        (Path(dir) / 'sub' / 'new.txt').write_text('hello\n')
+        (Path(dir) / 'sub' / 'newdir').mkdir()
+
+        assert watcher.handle_events(watcher.inotify.read_events(timeout=1))
+        assert watcher.pending == {b'/sub'}
+        assert b'/sub/newdir' in watcher.paths.values()
+        assert watcher.due()
+
+        taskmanager.queue.clear()
+        watcher.flush()
+        watcher.inotify.close()
+
+    [task_pk] = taskmanager.queue
+    task = models.Task.objects.get(pk=task_pk)
+    assert task.func == 'filesystem.walk'
+    assert task.args == [sub.pk]
+
+
+def test_walk_deletes_vanished_entries(taskmanager, monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'sub').mkdir()
+        (Path(dir) / 'sub' / 'a.txt').write_text('hello world\n')
+        (Path(dir) / 'b.txt').write_text('bye world\n')
+        root = models.Directory.objects.create()
+
+        filesystem.walk(root.pk)
+        [sub] = models.Directory.objects.filter(parent_directory=root)
+        filesystem.walk(sub.pk)
+        assert models.File.objects.count() == 2
+        assert models.Task.objects.filter(func='filesystem.walk').count() == 1
+
+        (Path(dir) / 'sub' / 'a.txt').unlink()
+        (Path(dir) / 'sub').rmdir()
+        filesystem.walk(root.pk)
+
+        assert list(models.Directory.objects.all()) == [root]
+        [file] = models.File.objects.all()
+        assert file.name == 'b.txt'
+        assert not models.Task.objects.filter(func='filesystem.walk').exists()
+        assert models.Task.objects.filter(func='filesystem.handle_file').count() == 1
+
+
+def test_walk_reindexes_documents_found_in_other_places(taskmanager, monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'a.txt').write_text('same\n')
+        (Path(dir) / 'b.txt').write_text('same\n')
+        root = models.Directory.objects.create()
+        filesystem.walk(root.pk)
+        [blob] = {f.blob for f in models.File.objects.all()}
+        index_task = models.Task.objects.create(
+            func='digests.index', blob_arg=blob, args=[blob.pk], status=models.Task.STATUS_SUCCESS,
+        )
+
+        (Path(dir) / 'b.txt').unlink()
+        filesystem.walk(root.pk)
+
+        [file] = models.File.objects.all()
+        assert file.name == 'a.txt'
+        index_task.refresh_from_db()
+        assert index_task.status == models.Task.STATUS_PENDING
+
+
+def test_walk_skips_entries_deleted_while_walking(taskmanager, monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'a.txt').write_text('hello\n')
+        (Path(dir) / 'b.txt').write_text('world\n')
+        root = models.Directory.objects.create()
+        filesystem.walk(root.pk)
+
+        (Path(dir) / 'c.txt').write_text('again\n')
+        stat_entries = filesystem.stat_entries
+
+        def delete_after_listing(path, names, vanished=None):
+            (Path(dir) / 'b.txt').unlink()
+            return stat_entries(path, names, vanished)
+
+        monkeypatch.setattr(filesystem, 'stat_entries', delete_after_listing)
+        filesystem.walk(root.pk)
+
+        assert sorted(f.name for f in models.File.objects.all()) == ['a.txt', 'c.txt']
+
+
+def test_walk_in_chunks(taskmanager, monkeypatch):
+    monkeypatch.setattr(settings, 'WALK_CHUNK_SIZE', 2)
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        for name in ['e.txt', 'd.txt', 'c.txt', 'b.txt', 'a.txt']:
+            (Path(dir) / name).write_text(name)
+        root = models.Directory.objects.create()
+
+        filesystem.walk(root.pk)
+        assert not models.File.objects.exists()
+        chunks = list(models.Task.objects.filter(func='filesystem.walk_chunk'))
+        assert len(chunks) == 3
+        [finish] = models.Task.objects.filter(func='filesystem.finish_walk')
+        assert finish.prev_set.count() == 3
+
+        for task in chunks:
+            filesystem.walk_chunk(*task.args)
+        assert sorted(f.name for f in models.File.objects.all()) == ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt']
+        root.refresh_from_db()
+        assert not root.fingerprint
+
+        filesystem.finish_walk(*finish.args)
+        root.refresh_from_db()
+        assert root.fingerprint == finish.args[2]
+
+        # nothing changed, so the directory is pruned and no chunks are queued again
+        filesystem.walk(root.pk)
+        assert models.Task.objects.filter(func='filesystem.walk_chunk').count() == 3
+
+
+def test_rewalk_only_hashes_changed_files(taskmanager, monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        monkeypatch.setattr(collections.Collection, 'DATA_DIR', dir)
+        (Path(dir) / 'a.txt').write_text('hello\n')
+        (Path(dir) / 'b.txt').write_text('world\n')
+        root = models.Directory.objects.create()
+        filesystem.walk(root.pk)
+        b = models.File.objects.get(name_bytes=b'b.txt')
+
+        (Path(dir) / 'b.txt').write_text('hello again, world\n')
+        root.fingerprint = ''
+        root.save()
+
+        ingested = []
+        ingest_files = filesystem.ingest_files
+        monkeypatch.setattr(filesystem, 'ingest_files',
+                            lambda paths: ingested.extend(paths) or ingest_files(paths))
+        filesystem.walk(root.pk)
+
+        assert [p.name for p in ingested] == ['b.txt']
+        b.refresh_from_db()
+        assert b.size == len('hello again, world\n')
+        assert models.File.objects.count() == 2
+
+
+def test_ingest_files_changed_after_hashing(monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        path = Path(dir) / 'a.txt'
+        path.write_text('before\n')
+        stat_and_hash = filesystem._stat_and_hash
+
+        def change_after_hashing(path):
+            result = stat_and_hash(path)
+            path.write_text('after\n')
+            return result
+
+        monkeypatch.setattr(filesystem, '_stat_and_hash', change_after_hashing)
+        [(_, _, blob)] = filesystem.ingest_files([path])
+
+        with blob.open() as f:
+            assert f.read() == b'after\n'